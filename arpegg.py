@@ -2,16 +2,103 @@
 
 import time
 import random
+import heapq
+import amy
+import tulip
+import engine
+import midiclock
+
+# Offloaded arpeggios: steps are this many of AMY's sequencer ticks (48 per
+# beat), with AMY's tempo set to match period_ms.
+OFFLOAD_STEP_TICKS = 12
+# Sequence tags used, from OFFLOAD_FIRST_TAG; longer arpeggios run in Python.
+OFFLOAD_FIRST_TAG = 1000
+OFFLOAD_MAX_ENTRIES = 128
+# Length of the pre-drawn cycle standing in for "rand" direction.
+RAND_CYCLE_STEPS = 32
+
+
+def _gcd(a, b):
+  while b:
+    a, b = b, a % b
+  return a
+
+
+class ArpPattern:
+  """The notes driving an arpeggio, expanded over octaves and direction on demand.
+
+  Held notes are kept sorted in a fixed buffer, and note(step) works out
+  each step's note from them, so key presses and UI changes never rebuild
+  a note list.
+  """
+
+  def __init__(self):
+    self.held = bytearray(128)
+    self.count = 0
+    self.octaves = 2
+    self.direction = "up"
+
+  def _index(self, note):
+    """Where note is, or would go, in held[:count]."""
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.held[mid] < note:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def add(self, note):
+    i = self._index(note)
+    if i < self.count and self.held[i] == note:
+      return
+    for j in range(self.count, i, -1):
+      self.held[j] = self.held[j - 1]
+    self.held[i] = note
+    self.count += 1
+
+  def remove(self, note):
+    i = self._index(note)
+    if i == self.count or self.held[i] != note:
+      return
+    self.count -= 1
+    for j in range(i, self.count):
+      self.held[j] = self.held[j + 1]
+
+  def clear(self):
+    self.count = 0
+
+  def length(self):
+    """Steps in one cycle of the arpeggio."""
+    n = self.count * self.octaves
+    if self.direction == "updown" and n > 2:
+      # Up then down, without repeating the top and bottom notes.
+      return 2 * n - 2
+    return n
+
+  def note(self, step):
+    """The note at step (0 to length() - 1) of the cycle."""
+    n = self.count * self.octaves
+    if self.direction == "down":
+      step = n - 1 - step
+    elif self.direction == "updown" and step >= n:
+      step = 2 * n - 2 - step
+    return self.held[step % self.count] + 12 * (step // self.count)
+
+  def notes(self):
+    return [self.note(i) for i in range(self.length())]
+
 
 class ArpeggiatorSynth:
   """Create arpeggios."""
   # State
   synth = None  # Downstream synthesizer object.
   current_active_notes = None  # Set of notes currently down on keyboard.
-  arpeggiate_base_notes = None  # Set of notes currently driving the arpeggio.
-  full_sequence = None  # List of notes in arpeggio (including direction and octave).
-  current_note = None  # Last note sent to synth (i.e., next note-off).
+  pattern = None  # ArpPattern of the notes currently driving the arpeggio.
+  current_note = None  # Last note sent to synth.
   current_step = -1  # Current position in sequence.
+  step_count = 0  # Steps played since the sequence started, for the step tables.
   running = False  # Currently mid-sequence.  Goes false if no notes are playing.
   # UI control items
   active = False
@@ -21,85 +108,335 @@ class ArpeggiatorSynth:
   period_ms = 125
   # Velocity for all the notes generated by the sequencer.
   velocity = 0.5
+  # Step tables, cycled through as the arpeggio plays (see set_steps()):
+  # per-step velocities (None for velocity throughout), gates as the
+  # fraction of a step each note sounds, and swing, the fraction of a step
+  # every second step is delayed.
+  velocities = None
+  gates = (1.0,)
+  swing = 0.0
+  # Bumped by set_steps(), so offload can tell the tables changed.
+  tables_version = 0
   # Notes at or above the split_note are always passed through live, not sequenced.
   split_note = 128  # Split is off the end of the keyboard, i.e., inactive.
+  # Likewise notes below low_note, so arpeggiators can share a keyboard (see ArpSplit).
+  low_note = 0
+  # Steps are sent to AMY with time= stamps this far ahead of when they play,
+  # so Python pauses shorter than this don't move them.
+  lookahead_ms = 50
+  # How often run() checks for a new sequence while idle.  The first step's
+  # time comes from the key press, not from when run() noticed it.
+  idle_poll_ms = 20
+  # Pause after the first key so chords go down together.
+  start_delay_ms = 10
+  # AMY time of the next step on the grid.
+  next_step_ms = None
+  # Measurement mode: collect how early each step was sent (see report()).
+  measure = False
+  # engine.Wakeup that task() waits on while idle.
+  wake = None
+  # ArpScheduler stepping this arpeggiator, if any, instead of its own run() or task().
+  scheduler = None
+  # Offload mode: AMY's sequencer loops the arpeggio, so a held pattern
+  # costs no Python per step.  It's recompiled when the pattern changes.
+  offload = False
+  offload_voices = None  # Two voices, alternated so each note can end as the next starts.
+  offload_tags = None  # AMY sequence tags holding the compiled loop.
+  offload_key = None  # What the loop in AMY was compiled from.
+  # External MIDI clock (midiclock.MidiClock) set by follow().  While it's
+  # playing, steps fall every clock_division pulses (6 = 16th notes) of its
+  # beat grid instead of every period_ms.
+  clock = None
+  clock_division = 6
+  next_step_pulse = None
   
   def __init__(self, synth):
     self.synth = synth
     self.current_active_notes = set()
-    self.arpeggiate_base_notes = set()
-    self.full_sequence = []
+    self.pattern = ArpPattern()
+    self.reset_measurement()
+    self.set_steps()
+
+  def plays(self, note):
+    """Whether note is arpeggiated rather than passed through."""
+    return self.active and self.low_note <= note < self.split_note
 
   def note_on(self, note, vel):
-    if not self.active or note >= self.split_note:
+    if not self.plays(note):
       return self.synth.note_on(note, vel)
     if self.hold and not self.current_active_notes:
       # First note after all keys off resets hold set.
-      self.arpeggiate_base_notes = set()
+      self.pattern.clear()
     # Adding keys to some already down.
     self.current_active_notes.add(note)
-    # Because it's a set, can't get more than one instance of a base note.
-    self.arpeggiate_base_notes.add(note)
-    self._update_full_sequence()
+    # The pattern holds each base note only once.
+    self.pattern.add(note)
+    self._update_pattern()
 
   def note_off(self, note):
-    if not self.active or note >= self.split_note:
+    if not self.plays(note):
       return self.synth.note_off(note)
-    #print(self.current_active_notes, self.arpeggiate_base_notes)
     # Update our internal record of keys currently held down.
     self.current_active_notes.remove(note)
     if not self.hold:
       # If not hold, remove notes from active set when released.
-      self.arpeggiate_base_notes.remove(note)
-      self._update_full_sequence()
+      self.pattern.remove(note)
+      self._update_pattern()
     
-  def _update_full_sequence(self):
-    """The full note loop given base_notes, octaves, and direction."""
-    # Basic notes, ascending.
-    basic_notes = sorted(self.arpeggiate_base_notes)
-    # Apply octaves
-    notes = []
-    for o in range(self.octaves):
-      notes = notes + [n + 12 * o for n in basic_notes]
-    # Apply direction
-    if self.direction == "down":
-      notes = notes[::-1]
-    elif self.direction == "updown":
-      notes = notes + notes[-2:0:-1]
-    self.full_sequence = notes
-    if self.full_sequence and not self.running:
+  def _update_pattern(self):
+    """Catch up with a change to the held notes, octaves or direction."""
+    self.pattern.octaves = self.octaves
+    self.pattern.direction = self.direction
+    if self.offload and not self._clocked():
+      self._update_offload()
+      return
+    if self.offload_tags:
+      # Offload was just switched off; carry on in Python.
+      self._stop_offload()
+    self._start_stepping()
+
+  def _start_stepping(self):
+    """Have run() or task() start stepping the sequence, if it isn't already."""
+    if self.pattern.count and not self.running:
       # Prepare to start a new sequence at the first note.
       self.current_step = -1
+      self.step_count = 0
+      # The step grid starts just after the key that started it.
+      self.next_step_ms = tulip.amy_ticks_ms() + self.start_delay_ms
+      self.next_step_pulse = None
       # Semaphore to the run loop to start going.
       self.running = True
+      if self.scheduler:
+        self.scheduler.schedule(self, self.next_step_ms - self.lookahead_ms)
+      elif self.wake:
+        self.wake.set()
 
-  def next_note(self):
-    if self.current_note:
-      self.synth.note_off(self.current_note)
-      self.current_note = None
-    if self.full_sequence:
-      if self.direction == "rand":
-        self.current_step = random.randint(0, len(self.full_sequence) - 1)
-      else:
-        self.current_step = (self.current_step + 1) % len(self.full_sequence)
-      self.current_note = self.full_sequence[self.current_step]
-      self.synth.note_on(self.current_note, self.velocity)
-    else:
+  def set_steps(self, velocities=None, gates=None, swing=None):
+    """Set any of the step tables, and precompute each step's timing from them.
+
+    A cycle of the tables is as many steps as it takes them all to come
+    round together.  For each, step_on and step_off hold when its note
+    starts and ends, in steps from its place on the grid, and step_vel its
+    velocity.  A note always ends by the time the next one starts.
+    """
+    if velocities is not None:
+      self.velocities = velocities
+    if gates is not None:
+      self.gates = gates
+    if swing is not None:
+      self.swing = swing
+    velocities = self.velocities or (self.velocity,)
+    gates = self.gates
+    cycle = 2 if self.swing else 1
+    for table in (velocities, gates):
+      cycle = cycle * len(table) // _gcd(cycle, len(table))
+    self.step_on = [self.swing if i % 2 else 0.0 for i in range(cycle)]
+    self.step_off = []
+    for i in range(cycle):
+      next_on = 1 + self.step_on[(i + 1) % cycle]
+      self.step_off.append(min(self.step_on[i] + gates[i % len(gates)], next_on))
+    self.step_vel = [velocities[i % len(velocities)] for i in range(cycle)]
+    self.tables_version += 1
+
+  def next_note(self, grid_ms, step_ms):
+    """Play the next step, on the grid at AMY time grid_ms, with steps step_ms long."""
+    if not self.pattern.count:
       self.running = False
+      return
+    if self.direction == "rand":
+      self.current_step = random.randint(0, self.pattern.length() - 1)
+    else:
+      self.current_step = (self.current_step + 1) % self.pattern.length()
+    j = self.step_count % len(self.step_vel)
+    self.step_count += 1
+    note = self.pattern.note(self.current_step)
+    on_ms = round(grid_ms + self.step_on[j] * step_ms)
+    if self.measure:
+      self._measure_step(on_ms - tulip.amy_ticks_ms())
+    # Both ends go out now, stamped; the gate never reaches the next step.
+    self.synth.note_on(note, self.step_vel[j], time=on_ms)
+    self.synth.note_off(note, time=round(grid_ms + self.step_off[j] * step_ms))
+    self.current_note = note
+
+  def send_due_steps(self, now_ms):
+    """Send every step on the grid before now_ms + lookahead_ms; return the ms until more are due."""
+    if self._clocked():
+      return self._send_clocked_steps(now_ms)
+    if self.running and self.next_step_ms + self.period_ms < now_ms:
+      # After a stall, drop the steps already missed rather than bursting them out.
+      missed = (now_ms - self.next_step_ms) // self.period_ms
+      self.next_step_ms += missed * self.period_ms
+    while self.running and self.next_step_ms < now_ms + self.lookahead_ms:
+      step_ms = self.next_step_ms
+      self.next_note(step_ms, self.period_ms)
+      # Steps are laid on an absolute grid, so time spent here doesn't accumulate.
+      self.next_step_ms = step_ms + self.period_ms
+    if not self.running:
+      return self.idle_poll_ms
+    return max(1, self.next_step_ms - self.lookahead_ms - now_ms)
+
+  def follow(self, clock):
+    """Step on clock's beat grid whenever it's playing."""
+    self.clock = clock
+    clock.transport_callbacks.append(self._transport)
+
+  def _clocked(self):
+    return self.clock is not None and self.clock.playing
+
+  def _transport(self, status):
+    if self.running:
+      if status == midiclock.STOP:
+        # Back to our own period, from now.
+        if self.current_note:
+          self.synth.note_off(self.current_note)
+          self.current_note = None
+        self.next_step_ms = tulip.amy_ticks_ms() + self.start_delay_ms
+      elif status == midiclock.START:
+        # Start is the top of the song, so the pattern starts over too.
+        self.current_step = -1
+    # Rejoin the clock's grid at its next step.
+    self.next_step_pulse = None
+    # Offload can only run off our own period.
+    self._update_pattern()
+
+  def _send_clocked_steps(self, now_ms):
+    """send_due_steps() on the external clock's grid."""
+    clock = self.clock
+    if not self.running or clock.slope is None:
+      return self.idle_poll_ms
+    step_pulses = self.clock_division
+    if self.next_step_pulse is None:
+      self.next_step_pulse = -(-clock.song_pulse() // step_pulses) * step_pulses
+    step_ms = clock.song_pulse_ms(self.next_step_pulse)
+    while self.running and step_ms < now_ms + self.lookahead_ms:
+      # Steps missed entirely (a stall) are dropped.
+      if step_ms + clock.ms_per_pulse() * step_pulses >= now_ms:
+        self.next_note(step_ms, clock.ms_per_pulse() * step_pulses)
+      self.next_step_pulse += step_pulses
+      step_ms = clock.song_pulse_ms(self.next_step_pulse)
+    if not self.running:
+      return self.idle_poll_ms
+    # The clock's estimate moves as pulses arrive, so look again soon.
+    return max(1, min(self.idle_poll_ms, int(step_ms - self.lookahead_ms - now_ms)))
 
   def run(self):
-    # Endless function that will emit sequencer notes when there are arpeggiate_base_notes.
+    # Endless function that will emit sequencer notes while there are notes in the pattern.
+    while True:
+      if not self.running:
+        time.sleep_ms(self.idle_poll_ms)
+      else:
+        time.sleep_ms(self.send_due_steps(tulip.amy_ticks_ms()))
+
+  async def task(self):
+    """run() as a cooperative task on an engine.Engine's event loop.
+
+    Sleeps until a sequence starts, then until each batch of steps is due.
+    """
+    self.wake = engine.Wakeup()
     while True:
       if not self.running:
-        time.sleep_ms(10)  # Break up the loop a little
+        await self.wake.wait()
+      else:
+        await engine.sleep_ms(self.send_due_steps(tulip.amy_ticks_ms()))
+
+  def _compile_offload(self):
+    """The arpeggio as AMY sequence entries (voice, tick, note, vel), and its period in ticks."""
+    steps = self.pattern.notes()
+    if self.direction == "rand":
+      # A long pre-drawn cycle stands in for picking each step afresh.
+      steps = [steps[random.randint(0, len(steps) - 1)] for _ in range(RAND_CYCLE_STEPS)]
+    # Go round until the notes and the step tables line up again, and an
+    # even number of steps, since the voices alternate.
+    tables = len(self.step_vel)
+    cycle = len(steps) * tables // _gcd(len(steps), tables)
+    if cycle % 2:
+      cycle *= 2
+    period = cycle * OFFLOAD_STEP_TICKS
+    entries = []
+    for i in range(cycle):
+      voice = self.offload_voices[i % 2]
+      j = i % tables
+      on = i * OFFLOAD_STEP_TICKS + round(self.step_on[j] * OFFLOAD_STEP_TICKS)
+      off = max(on + 1, i * OFFLOAD_STEP_TICKS + round(self.step_off[j] * OFFLOAD_STEP_TICKS))
+      entries.append((voice, on % period, steps[i % len(steps)], self.step_vel[j]))
+      entries.append((voice, off % period, None, 0))
+    return entries, period
+
+  def _update_offload(self):
+    key = (bytes(self.pattern.held[:self.pattern.count]), self.octaves, self.direction,
+           self.period_ms, self.tables_version)
+    if not self.active or not self.pattern.count:
+      self._stop_offload()
+      return
+    if key == self.offload_key:
+      # Nothing AMY is playing has changed.
+      return
+    if self.offload_voices is None:
+      self.offload_voices = self.synth.get_new_voices(2)
+    entries, period = self._compile_offload()
+    if len(entries) > OFFLOAD_MAX_ENTRIES:
+      # Too long for the sequencer; step it from Python instead.
+      self._stop_offload()
+      self._start_stepping()
+      return
+    if self.running:
+      # Hand over from Python stepping.
+      self.running = False
+      if self.current_note:
+        self.synth.note_off(self.current_note)
+        self.current_note = None
+    self._stop_offload()
+    # Set AMY's tempo so OFFLOAD_STEP_TICKS (at 48 per beat) last period_ms.
+    amy.send(tempo=60000 * OFFLOAD_STEP_TICKS / (48 * self.period_ms))
+    # Start the loop at the next step boundary, like a new Python sequence.
+    start = tulip.seq_ticks() + OFFLOAD_STEP_TICKS
+    self.offload_tags = []
+    for i, (voice, tick, note, vel) in enumerate(entries):
+      tag = OFFLOAD_FIRST_TAG + i
+      sequence = '%d,%d,%d' % ((start + tick) % period, period, tag)
+      if note is None:
+        voice.note_off(sequence=sequence)
       else:
-        # self.running started sequence.
-        # Another brief pause to let all keys go down
-        time.sleep_ms(10)
-        # Cycle the notes as long as we have them.
-        while self.running:
-          self.next_note()
-          time.sleep_ms(self.period_ms)
+        voice.note_on(note, vel, sequence=sequence)
+      self.offload_tags.append(tag)
+    self.offload_key = key
+
+  def _stop_offload(self):
+    """Clear the loop from AMY's sequencer and silence its voices."""
+    if self.offload_tags:
+      for tag in self.offload_tags:
+        amy.send(sequence='0,0,%d' % tag)
+      for voice in self.offload_voices:
+        voice.note_off()
+    self.offload_tags = None
+    self.offload_key = None
+
+  def reset_measurement(self):
+    self.steps_measured = 0
+    self.late_steps = 0
+    self.max_late_ms = 0
+    self.min_lead_ms = None
+    self.total_lead_ms = 0
+
+  def _measure_step(self, lead_ms):
+    # lead_ms is how far ahead of its grid time a step reached AMY.  A
+    # negative lead means it was sent late and AMY played it that late.
+    self.steps_measured += 1
+    self.total_lead_ms += lead_ms
+    if self.min_lead_ms is None or lead_ms < self.min_lead_ms:
+      self.min_lead_ms = lead_ms
+    if lead_ms < 0:
+      self.late_steps += 1
+      self.max_late_ms = max(self.max_late_ms, -lead_ms)
+
+  def report(self):
+    """Print the step-time error seen since measure was set."""
+    if not self.steps_measured:
+      print('arp: no steps measured')
+      return
+    print('arp: %d steps, %d late (max %d ms), lead min %d ms mean %.1f ms' % (
+      self.steps_measured, self.late_steps, self.max_late_ms, self.min_lead_ms,
+      self.total_lead_ms / self.steps_measured))
 
   def control_change(self, control, value):
     #if not self.active:
@@ -112,7 +449,7 @@ class ArpeggiatorSynth:
       self.cycle_direction()
     else:
       self.control_change_fwd_fn(control, value)
-    self._update_full_sequence()
+    self._update_pattern()
 
   def _cycle_octaves(self):
     self.octaves = 1 + (self.octaves % 3)
@@ -137,14 +474,120 @@ class ArpeggiatorSynth:
     elif arg == 'hold':
       self.hold = val
       # Copy across the current_active_notes after a change in hold.
-      self.arpeggiate_base_notes = set(self.current_active_notes)
+      self.pattern.clear()
+      for note in self.current_active_notes:
+        self.pattern.add(note)
+    elif arg == 'measure':
+      # Start (or stop) collecting step timing; report() prints it.
+      if val:
+        self.reset_measurement()
+      else:
+        self.report()
+      self.measure = val
+    elif arg == 'offload':
+      self.offload = val
+    elif arg == 'swing':
+      self.set_steps(swing=val)
     elif arg == 'arp_rate':
       self.period_ms = int(1000 / (2.0 ** (5 * val)))  # 1 Hz to 32 Hz
     elif arg == 'octaves':
       self.octaves = val
     else:
       self.direction = arg
-    self._update_full_sequence()
+    self._update_pattern()
+
+  def get_new_voices(self, num_voices):
+    return self.synth.get_new_voices(num_voices)
+
+
+class ArpScheduler:
+  """Step any number of arpeggiators from one timer.
+
+  A heap holds when each running arpeggiator next has steps to send, so
+  one loop sleeps until the earliest, whatever their rates; idle ones
+  aren't in it at all.
+  """
+  idle_poll_ms = 20
+
+  def __init__(self):
+    self.heap = []
+    # Tie-break for the heap, as arpeggiators don't compare.
+    self.count = 0
+    self.wake = None
+
+  def add(self, arp):
+    arp.scheduler = self
+    if arp.running:
+      self.schedule(arp, tulip.amy_ticks_ms())
+
+  def schedule(self, arp, due_ms):
+    self.count += 1
+    heapq.heappush(self.heap, (due_ms, self.count, arp))
+    if self.wake:
+      self.wake.set()
+
+  def service(self, now_ms):
+    """Send the steps that are due; return the ms until more are, or None if all are idle."""
+    heap = self.heap
+    while heap and heap[0][0] <= now_ms:
+      arp = heapq.heappop(heap)[2]
+      if not arp.running or any(entry[2] is arp for entry in heap):
+        # Stopped, or started again and already back in the heap.
+        continue
+      wait_ms = arp.send_due_steps(now_ms)
+      if arp.running:
+        self.count += 1
+        heapq.heappush(heap, (now_ms + wait_ms, self.count, arp))
+    if not heap:
+      return None
+    return max(1, int(heap[0][0] - now_ms))
+
+  def run(self):
+    # Endless, blocking; task() is the cooperative version.
+    while True:
+      wait_ms = self.service(tulip.amy_ticks_ms())
+      time.sleep_ms(self.idle_poll_ms if wait_ms is None else wait_ms)
+
+  async def task(self):
+    self.wake = engine.Wakeup()
+    while True:
+      wait_ms = self.service(tulip.amy_ticks_ms())
+      if wait_ms is None:
+        await self.wake.wait()
+      else:
+        await engine.sleep_ms(wait_ms)
+
+
+class ArpSplit:
+  """Share a keyboard between arpeggiators by their note ranges.
+
+  Stands where one ArpeggiatorSynth would (e.g. as polyvoice.SYNTH): each
+  note goes to the first arpeggiator that plays it, and notes none of them
+  play go straight to synth.  Each arpeggiator sends its steps to its own
+  synth, so they can drive different voices.
+  """
+
+  def __init__(self, arps, synth):
+    self.arps = arps
+    self.synth = synth
+
+  def _arp_for(self, note):
+    for arp in self.arps:
+      if arp.plays(note):
+        return arp
+    return None
+
+  def note_on(self, note, vel, time=None):
+    arp = self._arp_for(note)
+    if arp is None:
+      return self.synth.note_on(note, vel, time=time)
+    arp.note_on(note, vel)
+
+  def note_off(self, note, time=None):
+    arp = self._arp_for(note)
+    if arp is None:
+      return self.synth.note_off(note, time=time)
+    arp.note_off(note)
 
   def get_new_voices(self, num_voices):
     return self.synth.get_new_voices(num_voices)
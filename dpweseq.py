@@ -9,17 +9,33 @@
 #  - Save & Load of sequences
 #  - mute track button
 #  - metronome
+#  - crash-safe recording journal, folded into the saved sequence on save
+#  - compact binary save format, loaded in the background visible-blocks-first
+#  - Standard MIDI File import/export
+#  - notes stored in musical ticks, converted to ms through a tempo map
+#  - loop playback, handed to AMY's sequencer when it fits
+#  - mute and playhead moves while playing, re-issuing only the affected notes
+#  - tracks sharing a synth no longer cut off each other's overlapping notes
+#  - per-track routing to an AMY synth or MIDI out, sent in batches
+#  - controller, pitch-bend and aftertouch automation, thinned after each take
+#  - bulk edits (quantize, transpose, velocity, stretch, humanize) as one undo step
+#  - touch editing: drag notes to move them, drag their ends to resize
+#  - recorded notes compensated for input latency, measured by MIDI loopback
+#  - playhead predicted from the system clock, redrawn only when it moves a pixel
+#  - follows external MIDI clock start/stop, with the metronome at its tempo
 # TODO
-#  - playback routing: Send MIDI events rather than Synth.note_* events?  As an option?
+#  - UI for choosing each track's destination
 #  - add metronome on/off, controls for BPM and meter
-# ISSUES
-#  - when two tracks play to the same synth, the note-offs can cancel each other's overlapping notes
-#  - Toggling while playing doesn't work (we'd need to reschedule everything)
-#  - Moving playhead while playing doesn't work (we'd need to reschedule everything)
 
 import synth, tulip, midi, amy
 import ui
 import json  # for load/save
+import array
+import heapq
+import random
+import seqfile
+import midifile
+import midiclock
 
 app = None
 (screen_width, screen_height) = tulip.screen_size()
@@ -27,15 +43,166 @@ app = None
 midi_channels = [None] * 4
 all_active_channels = set()
 
+# Note times are in musical ticks; the tempo map converts them to ms.
+TICKS_PER_BEAT = 480
+
 def app_hwm(tick):
     """Set the app time high water mark."""
     global app
-    if(tick > app.last_ms): app.last_ms = tick
+    if(tick > app.last_tick): app.last_tick = tick
 
 
-def _ms_to_x(ms):
+def _tick_to_x(tick):
     global app
-    return int((ms - app.x_offset_ms) / app.ms_per_px)
+    return int((tick - app.x_offset_tick) / app.ticks_per_px)
+
+def _first_note_at(notes, tick):
+    """Index of the first of the on_tick-sorted notes starting at or after tick."""
+    lo, hi = 0, len(notes)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if notes[mid].on_tick < tick:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class TempoMap:
+    """Piecewise-constant tempo, for converting between ticks and ms.
+
+    Segment i runs at bpms[i] from ticks[i] to the next segment.  start_ms
+    caches when each segment starts, so a conversion either way is a binary
+    search plus one multiply, and changing the tempo only rebuilds this
+    table; the notes, stored in ticks, are untouched.
+    """
+
+    def __init__(self, bpm=108):
+        self.ticks = [0]
+        self.bpms = [bpm]
+        self.start_ms = [0]
+
+    def _rebuild(self):
+        self.start_ms = [0]
+        for i in range(1, len(self.ticks)):
+            self.start_ms.append(self.start_ms[-1] + (self.ticks[i] - self.ticks[i - 1]) * self.ms_per_tick(i - 1))
+
+    def ms_per_tick(self, segment):
+        return 60000 / (self.bpms[segment] * TICKS_PER_BEAT)
+
+    @staticmethod
+    def _last_at_or_before(values, value):
+        """Index of the last of the sorted values <= value (0 if none)."""
+        lo, hi = 0, len(values) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if values[mid] <= value:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def segment_at(self, tick):
+        return self._last_at_or_before(self.ticks, tick)
+
+    def tick_to_ms(self, tick):
+        i = self._last_at_or_before(self.ticks, tick)
+        return self.start_ms[i] + (tick - self.ticks[i]) * self.ms_per_tick(i)
+
+    def ms_to_tick(self, ms):
+        i = self._last_at_or_before(self.start_ms, ms)
+        return self.ticks[i] + (ms - self.start_ms[i]) / self.ms_per_tick(i)
+
+    def bpm_at(self, tick):
+        return self.bpms[self.segment_at(tick)]
+
+    def set_tempo(self, bpm, tick=0):
+        """Change tempo from tick up to the next tempo change."""
+        i = self.segment_at(tick)
+        if self.ticks[i] == tick:
+            self.bpms[i] = bpm
+        else:
+            self.ticks.insert(i + 1, tick)
+            self.bpms.insert(i + 1, bpm)
+        self._rebuild()
+
+    def remove_tempo_change(self, tick):
+        i = self.segment_at(tick)
+        if i > 0 and self.ticks[i] == tick:
+            del self.ticks[i]
+            del self.bpms[i]
+            self._rebuild()
+
+    def segments(self):
+        """List of (start_tick, bpm)."""
+        return list(zip(self.ticks, self.bpms))
+
+    def set_segments(self, segments):
+        """Replace the map with (start_tick, bpm) segments, the first starting at 0."""
+        self.ticks = [tick for tick, _ in segments]
+        self.bpms = [bpm for _, bpm in segments]
+        self._rebuild()
+
+
+# Shades for the position-bar density overview, sparse to dense.
+DENSITY_COLORS = [146, 182, 219, 255]
+
+class DensityMipmap:
+    """Counts of note onsets per time bucket, at a ladder of resolutions.
+
+    Level 0 counts notes in buckets of bucket_ticks; each level above merges
+    pairs of buckets from the one below.  Adding or removing a note touches
+    one bucket per level, and an overview of any span can be read from the
+    coarsest level that still resolves it, without looking at the notes.
+    """
+
+    def __init__(self, bucket_ticks=TICKS_PER_BEAT // 2):
+        self.bucket_ticks = bucket_ticks
+        self.levels = [array.array('H')]
+
+    def _grow(self, index):
+        """Make sure level 0 has a bucket for index, extending levels above."""
+        level0 = self.levels[0]
+        if index < len(level0):
+            return
+        while len(level0) <= index:
+            level0.append(0)
+        k = 1
+        while k < len(self.levels) or len(self.levels[k - 1]) > 1:
+            if k == len(self.levels):
+                self.levels.append(array.array('H'))
+            below = self.levels[k - 1]
+            level = self.levels[k]
+            while len(level) < (len(below) + 1) // 2:
+                i = 2 * len(level)
+                count = below[i] + (below[i + 1] if i + 1 < len(below) else 0)
+                level.append(min(count, 65535))
+            k += 1
+
+    def add(self, tick, delta=1):
+        """Count (or with delta=-1, uncount) a note starting at tick."""
+        index = int(tick // self.bucket_ticks)
+        if index < 0:
+            return
+        self._grow(index)
+        for level in self.levels:
+            level[index] = max(0, min(level[index] + delta, 65535))
+            index >>= 1
+
+    def clear(self):
+        self.levels = [array.array('H')]
+
+    def rebuild(self, notes):
+        self.clear()
+        for note in notes:
+            self.add(note.on_tick)
+
+    def level_for(self, span_ticks, max_buckets):
+        """Return (bucket_ticks, counts) for the finest level with at most max_buckets over span_ticks."""
+        k = 0
+        while k < len(self.levels) - 1 and span_ticks / (self.bucket_ticks << k) > max_buckets:
+            k += 1
+        return self.bucket_ticks << k, self.levels[k]
+
 
 # dpwe to make this more real. 
 class SeqNote:
@@ -59,29 +226,19 @@ class SeqNote:
         global app
         # We allow specifying the color not least to support erasing with the background color.
         # only draw if fits in view
-        if(self.on_tick >= app.x_offset_ms and self.on_tick < app.x_offset_ms + (app.ms_per_px*screen_width)):
+        if(self.on_tick >= app.x_offset_tick and self.on_tick < app.x_offset_tick + (app.ticks_per_px*screen_width)):
             # handle midi notes 30-90
             if(self.note > 29 and self.note < 90):
                 # height of channel is 120
                 cy = 120 - ((self.note - 29) * 2)
-                cx_on = _ms_to_x(self.on_tick)
+                cx_on = _tick_to_x(self.on_tick)
                 if self.off_tick is not None:
-                    cx_off = _ms_to_x(self.off_tick)
+                    cx_off = _tick_to_x(self.off_tick)
                 else:
                     # Note is still down - draw bar up to cursor
-                    cx_off = _ms_to_x(app.playhead_ms)
+                    cx_off = _tick_to_x(app.playhead_tick)
                 tulip.bg_rect(base_x + cx_on, base_y + cy, cx_off - cx_on + 2, 2, color, 1)
 
-    def schedule(self, note_on_fn, note_off_fn=None, offset=0):
-        global app
-        if note_on_fn:
-           note_on_fn(self.note, self.vel / 127, time=self.on_tick - offset)
-           if self.off_tick is not None:
-               if note_off_fn:
-                   note_off_fn(self.note, time=self.off_tick - offset)
-               else:
-                   note_on_fn(self.note, 0, time=self.off_tick - offset)
-                
     def as_list(self):
         """Return list of scalars, for saving as json."""
         duration = self.off_tick - self.on_tick if self.off_tick is not None else None
@@ -94,10 +251,212 @@ class SeqNote:
         return SeqNote(note=note, vel=vel, channel=channel, tick=on_tick, duration=duration)
 
 
+# Status nibbles recorded into automation lanes: poly aftertouch, control
+# change, channel aftertouch, pitch bend.
+AUTOMATION_KINDS = (0xA0, 0xB0, 0xD0, 0xE0)
+# How far thinning may move a lane, about 1/128 of each kind's range.
+AUTOMATION_TOLERANCE = {0xA0: 1, 0xB0: 1, 0xD0: 1, 0xE0: 128}
+# Playback sends values between a lane's points no more often than this.
+AUTOMATION_STEP_TICKS = TICKS_PER_BEAT // 16
+
+class AutomationLane:
+    """One controller's moves on a track, as tick deltas and values in arrays.
+
+    Values are interpolated linearly between points on playback, which is
+    what lets thin() drop most of a recording's points.  A held value
+    followed by a jump is two points at the jump's tick.
+    """
+
+    def __init__(self, kind, controller):
+        self.kind = kind
+        self.controller = controller
+        # Tick of each point after the one before (the first after tick 0).
+        self.deltas = array.array('l')
+        # Values are signed, centred on 0 for pitch bend.
+        self.values = array.array('h')
+        self.last_tick = 0
+
+    def append(self, tick, value):
+        """Add a point at or after the last one."""
+        tick = max(tick, self.last_tick)
+        if self.values and tick - self.last_tick > AUTOMATION_STEP_TICKS:
+            # The value was held until now, rather than ramping here.
+            self.deltas.append(tick - self.last_tick)
+            self.values.append(self.values[-1])
+            self.last_tick = tick
+        self.deltas.append(tick - self.last_tick)
+        self.values.append(value)
+        self.last_tick = tick
+
+    def points(self, cursor=None):
+        """(tick, value) for each point, or for those from cursor (see cursor_before) on."""
+        index, tick = 0, 0
+        if cursor is not None:
+            index, tick = cursor
+            tick -= self.deltas[index]
+        deltas, values = self.deltas, self.values
+        for i in range(index, len(values)):
+            tick += deltas[i]
+            yield tick, values[i]
+
+    def cursor_before(self, tick, cursor=None):
+        """(index, tick) of the last point before tick, searching on from cursor.
+
+        Gives value_events() somewhere to start without walking the lane
+        from the top; None for an empty lane.  If no point is before tick,
+        it's the first point.
+        """
+        deltas = self.deltas
+        if not deltas:
+            return None
+        index, point_tick = cursor if cursor is not None else (0, deltas[0])
+        while index + 1 < len(deltas) and point_tick + deltas[index + 1] < tick:
+            index += 1
+            point_tick += deltas[index]
+        return index, point_tick
+
+    def truncated(self, tick):
+        """A copy of the lane with only the points before tick."""
+        lane = AutomationLane(self.kind, self.controller)
+        for point_tick, value in self.points():
+            if point_tick >= tick:
+                break
+            lane.deltas.append(point_tick - lane.last_tick)
+            lane.values.append(value)
+            lane.last_tick = point_tick
+        return lane
+
+    def thin(self, tolerance, from_tick=0):
+        """Drop points from from_tick on that interpolation gets within tolerance of.
+
+        Ramer-Douglas-Peucker, measuring error in value at each point's tick,
+        with a stack rather than recursion.
+        """
+        points = list(self.points())
+        first = 0
+        while first < len(points) and points[first][0] < from_tick:
+            first += 1
+        if len(points) - first < 3:
+            return
+        keep = bytearray(len(points))
+        for i in range(first):
+            keep[i] = 1
+        keep[first] = keep[-1] = 1
+        stack = [(first, len(points) - 1)]
+        while stack:
+            start, end = stack.pop()
+            (t0, v0), (t1, v1) = points[start], points[end]
+            worst, worst_error = 0, tolerance
+            for i in range(start + 1, end):
+                t, v = points[i]
+                expected = v0 if t1 == t0 else v0 + (v1 - v0) * (t - t0) / (t1 - t0)
+                error = abs(v - expected)
+                if error > worst_error:
+                    worst, worst_error = i, error
+            if worst:
+                keep[worst] = 1
+                stack.append((start, worst))
+                stack.append((worst, end))
+        self.deltas = array.array('l')
+        self.values = array.array('h')
+        self.last_tick = 0
+        for i, (tick, value) in enumerate(points):
+            if keep[i]:
+                self.deltas.append(tick - self.last_tick)
+                self.values.append(value)
+                self.last_tick = tick
+
+    def value_at(self, tick):
+        """The lane's value at tick, or None before its first point."""
+        prev = None
+        for point in self.points():
+            if point[0] > tick:
+                if prev is None:
+                    return None
+                (t0, v0), (t1, v1) = prev, point
+                return v0 + int((v1 - v0) * (tick - t0) / (t1 - t0))
+            prev = point
+        return prev[1] if prev else None
+
+    def value_events(self, start_tick, end_tick, cursor=None):
+        """Yield (tick, value) to send for [start_tick, end_tick).
+
+        That's each point, plus interpolated values every
+        AUTOMATION_STEP_TICKS between points.  cursor, from
+        cursor_before(start_tick), skips the points before it.
+        """
+        prev = None
+        for tick, value in self.points(cursor):
+            if tick >= end_tick and prev is not None and prev[0] >= end_tick:
+                return
+            if prev is not None and tick > prev[0] and tick > start_tick:
+                t0, v0 = prev
+                step = AUTOMATION_STEP_TICKS
+                # First grid point after t0 at or after start_tick.
+                grid = t0 + max(1, -(-(start_tick - t0) // step)) * step
+                while grid < tick and grid < end_tick:
+                    yield grid, v0 + int((value - v0) * (grid - t0) / (tick - t0))
+                    grid += step
+            if start_tick <= tick < end_tick:
+                yield tick, value
+            prev = (tick, value)
+
+
+# Hit-test buckets are this many ticks wide.
+HIT_BUCKET_TICKS = TICKS_PER_BEAT
+
+class NoteIndex:
+    """Which notes cover each (time bucket, pitch), for hit-testing touches.
+
+    A note is listed in every bucket its bar overlaps, so finding the note
+    under a point reads one bucket per pitch row tried, however many notes
+    the track holds.
+    """
+
+    def __init__(self, bucket_ticks=HIT_BUCKET_TICKS):
+        self.bucket_ticks = bucket_ticks
+        # (bucket, note number) -> list of SeqNotes.
+        self.buckets = {}
+
+    def _keys(self, note):
+        end_tick = note.on_tick if note.off_tick is None else note.off_tick
+        for bucket in range(int(note.on_tick // self.bucket_ticks), int(end_tick // self.bucket_ticks) + 1):
+            yield bucket, note.note
+
+    def add(self, note):
+        for key in self._keys(note):
+            notes = self.buckets.get(key)
+            if notes is None:
+                self.buckets[key] = [note]
+            else:
+                notes.append(note)
+
+    def remove(self, note):
+        for key in self._keys(note):
+            notes = self.buckets.get(key)
+            if notes is not None and note in notes:
+                notes.remove(note)
+                if not notes:
+                    del self.buckets[key]
+
+    def hit(self, tick, note_number, slop_ticks=0, slop_notes=1):
+        """The note nearest (tick, note_number), within the slops, or None."""
+        best, best_distance = None, None
+        bucket = int(tick // self.bucket_ticks)
+        for n in range(note_number - slop_notes, note_number + slop_notes + 1):
+            for note in self.buckets.get((bucket, n), ()):
+                end_tick = note.on_tick if note.off_tick is None else note.off_tick
+                if note.on_tick - slop_ticks <= tick <= end_tick + slop_ticks:
+                    distance = abs(n - note_number)
+                    if best is None or distance < best_distance:
+                        best, best_distance = note, distance
+        return best
+
+
 class Track:
     """A single track of the sequencer."""
 
-    def __init__(self, index, x, y, w=0, h=0, fg_color=93, bg_color=32, note_on_fn=None, note_off_fn=None):
+    def __init__(self, index, x, y, w=0, h=0, fg_color=93, bg_color=32, dest=None):
         global screen_width, screen_height
         self.index = index
         self.x = x
@@ -106,15 +465,28 @@ class Track:
         self.h = h if h else screen_height // 5
         self.fg_color = fg_color
         self.bg_color = bg_color
-        self.note_on_fn = note_on_fn
-        self.note_off_fn = note_off_fn
+        # Where playback goes: an AmySynthDest or MidiOutDest.
+        self.dest = dest
+        # Kept sorted by on_tick.
         self.notes = []
-        self.saved_notes = []
         self.live_notes_dict = {}
+        # Where in notes the current recording take starts.
+        self.take_start = 0
+        # Note-onset counts for the position-bar overview.
+        self.density = DensityMipmap()
+        # Finished notes by time and pitch, for touch editing.
+        self.hit_index = NoteIndex()
+        # (kind, controller) -> AutomationLane.
+        self.lanes = {}
+        # Lanes as they were before the current take, for its undo; None for new ones.
+        self.take_lanes = {}
+        self.take_start_tick = 0
         # Setup sprite
         tulip.sprite_register(index, 0, 1, self.h)
         tulip.sprite_on(index)
         tulip.sprite_move(index, self.x, self.y)
+        # Screen x the playhead sprite was last moved to.
+        self.playhead_x = self.x
         # Setup record button
         self.rec_button = tulip.UIButton(text="R", bg_color=0x49, fg_color=255, callback=self.rec_pushed)
         app.add(self.rec_button, x=self.x - 80, y=self.y - 0)
@@ -150,28 +522,92 @@ class Track:
         self.muted = val
         color = 0xD4 if self.muted else 0x49
         self.mute_button.button.set_style_bg_color(ui.pal_to_lv(color), ui.lv.PART.MAIN)
-
-    def clear_notes(self, clear_from_ms=0):
-        """Save current notes, clear notes, redraw."""
-        if self.notes:
-            self.saved_notes = self.notes
-            add_undo_object(self)
-        # Keep notes that start before clear_from_ms
-        self.notes = [n for n in self.notes if n.on_tick < clear_from_ms]
-        self.draw()
-
-    def undo(self):
-        """Restore the saved_notes, swap with current notes."""
-        self.notes, self.saved_notes = self.saved_notes, self.notes
+        if app.playing or app.recording:
+            mute_changed(self)
+
+    def insert_notes(self, index, notes):
+        """Insert on_tick-sorted notes into self.notes at index."""
+        self.notes[index:index] = notes
+        for note in notes:
+            self.density.add(note.on_tick)
+            self.hit_index.add(note)
+            app_hwm(note.on_tick if note.off_tick is None else note.off_tick)
+        app.position_bar_dirty = True
+
+    def delete_notes(self, start, end):
+        """Remove self.notes[start:end] and return them."""
+        removed = self.notes[start:end]
+        del self.notes[start:end]
+        for note in removed:
+            self.density.add(note.on_tick, -1)
+            self.hit_index.remove(note)
+        app.position_bar_dirty = True
+        return removed
+
+    def clear_notes(self, clear_from_tick=0):
+        """Clear notes starting at or after clear_from_tick (with undo), redraw."""
+        start = _first_note_at(self.notes, clear_from_tick)
+        if start < len(self.notes):
+            app.undo.add_delta(self, start, self.delete_notes(start, len(self.notes)), False)
         self.draw()
 
-    def redo(self):
-        """Redo - is the same as undo, since we're swapping one history."""
-        self.undo()
-
-    def move_playhead(self, time_ms):
+    def start_take(self, clear_from_tick):
+        """Prepare to record: clear from clear_from_tick and note where the take begins."""
+        self.clear_notes(clear_from_tick)
+        self.take_start = len(self.notes)
+        self.take_start_tick = clear_from_tick
+        self.take_lanes = {}
+        for key, lane in self.lanes.items():
+            self.lanes[key] = lane.truncated(clear_from_tick)
+            if len(self.lanes[key].values) != len(lane.values):
+                self.take_lanes[key] = lane
+
+    def end_take(self):
+        """Journal the notes recorded since start_take() as an insert, thin its automation."""
+        if self.take_start < len(self.notes):
+            app.undo.add_delta(self, self.take_start, self.notes[self.take_start:], True)
+            # Recorded notes went straight into self.notes; now they have ends they can be hit-tested.
+            for note in self.notes[self.take_start:]:
+                self.hit_index.add(note)
+        for key, old_lane in self.take_lanes.items():
+            lane = self.lanes[key]
+            lane.thin(AUTOMATION_TOLERANCE[lane.kind], self.take_start_tick)
+            app.undo.add_delta(self, key, [old_lane, lane], None)
+        self.take_lanes = {}
+
+    def set_lane(self, key, lane):
+        """Replace (or with None, remove) a lane."""
+        if lane is None:
+            self.lanes.pop(key, None)
+        else:
+            self.lanes[key] = lane
+
+    def replace_lanes(self, lanes, undoable=True):
+        """Swap in a whole new set of lanes, with undo unless undoable is False."""
+        for key in set(self.lanes) | set(lanes):
+            old_lane, lane = self.lanes.get(key), lanes.get(key)
+            if old_lane is not lane:
+                if undoable:
+                    app.undo.add_delta(self, key, [old_lane, lane], None)
+                self.set_lane(key, lane)
+
+    def record_automation(self, kind, controller, value, tick):
+        key = (kind, controller)
+        lane = self.lanes.get(key)
+        if key not in self.take_lanes:
+            self.take_lanes[key] = lane
+            # Keep the pre-take lane intact for undo.
+            lane = lane.truncated(tick + 1) if lane else AutomationLane(kind, controller)
+            self.lanes[key] = lane
+        lane.append(tick, value)
+
+    def move_playhead(self, tick):
         global app
-        x = self.x + _ms_to_x(time_ms)
+        x = self.x + _tick_to_x(tick)
+        # Nothing to redraw until the playhead reaches the next pixel.
+        if x == self.playhead_x:
+            return
+        self.playhead_x = x
 
         # Extend non-terminated notes to playhead.
         self.draw_live_notes()
@@ -179,17 +615,59 @@ class Track:
         tulip.sprite_move(self.index, x, self.y)
 
     def draw(self):
+        # Live notes are painted over, so redraw them at the next playhead move.
+        self.playhead_x = None
         tulip.bg_rect(self.x, self.y, self.w, self.h, self.bg_color, 1)
-        for note in self.notes:
-            note.draw(base_x=self.x, base_y=self.y, color=self.fg_color)
-
-    def schedule_notes(self, offset_ms=0):
-        if self.muted:
+        view_start = app.x_offset_tick
+        view_end = view_start + app.ticks_per_px * screen_width
+        # Only notes starting in view get drawn.
+        for i in range(_first_note_at(self.notes, view_start), _first_note_at(self.notes, view_end)):
+            self.notes[i].draw(base_x=self.x, base_y=self.y, color=self.fg_color)
+
+    def draw_range(self, start_tick, end_tick):
+        """Redraw just the part of the track showing start_tick to end_tick."""
+        view_start = app.x_offset_tick
+        view_end = view_start + app.ticks_per_px * screen_width
+        start_tick = max(start_tick, view_start)
+        end_tick = min(end_tick, view_end)
+        if start_tick >= end_tick:
+            return
+        x = self.x + _tick_to_x(start_tick)
+        tulip.bg_rect(x, self.y, self.x + _tick_to_x(end_tick) + 2 - x, self.h, self.bg_color, 1)
+        notes = self.notes
+        for i in range(_first_note_at(notes, view_start), _first_note_at(notes, end_tick)):
+            note = notes[i]
+            # Notes starting earlier only need redrawing if they reach into the range.
+            if note.on_tick >= start_tick or note.off_tick is None or note.off_tick >= start_tick:
+                note.draw(base_x=self.x, base_y=self.y, color=self.fg_color)
+
+    def edit_notes(self, transform, start_tick=0, end_tick=None):
+        """Replace each note starting in [start_tick, end_tick) with transform(note).
+
+        transform returns a new SeqNote, leaving the old one for undo.  The
+        whole edit is one undo step and one redraw.
+        """
+        notes = self.notes
+        start = _first_note_at(notes, start_tick)
+        end = len(notes) if end_tick is None else _first_note_at(notes, end_tick)
+        if start == end:
             return
-        for note in self.notes:
-            # Only schedule things ahead of the playhead when we start
-            if(note.on_tick > offset_ms):
-                note.schedule(offset=offset_ms, note_on_fn=self.note_on_fn, note_off_fn=self.note_off_fn)
+        edited = [transform(note) for note in notes[start:end]]
+        edited.sort(key=lambda note: note.on_tick)
+        # Edited notes may have moved past untouched ones; take those along to keep notes sorted.
+        lo = min(start, _first_note_at(notes, edited[0].on_tick))
+        hi = max(end, _first_note_at(notes, edited[-1].on_tick + 1))
+        merged = notes[lo:start] + edited + notes[end:hi]
+        merged.sort(key=lambda note: note.on_tick)
+        app.undo.begin()
+        old = self.delete_notes(lo, hi)
+        app.undo.add_delta(self, lo, old, False)
+        self.insert_notes(lo, merged)
+        app.undo.add_delta(self, lo, merged, True)
+        app.undo.commit()
+        changed = old + merged
+        self.draw_range(min(note.on_tick for note in changed),
+                        max(note.on_tick if note.off_tick is None else note.off_tick for note in changed))
 
     def consume_midi_event(self, message, tick):
         global app
@@ -197,11 +675,16 @@ class Track:
         channel = (message[0] & 0x0F) + 1
         control = message[1]
         value = message[2] if len(message) > 2 else None
+        if method == 0x90 or method == 0x80 or method in AUTOMATION_KINDS:
+            # Get the event onto the crash-safe journal before anything else.
+            app.journal.append(self.index, message[0], control, value or 0, tick)
         if(method == 0x90): # note on
             note = control
             seq_note = SeqNote(note, value, tick, channel)
             self.live_notes_dict[(channel, note)] = seq_note
             self.notes.append(seq_note)
+            self.density.add(tick)
+            app.position_bar_dirty = True
             app_hwm(tick)            
         if(method == 0x80): #note off
             note = control
@@ -212,6 +695,12 @@ class Track:
                 app_hwm(tick)
             else:
                 print('unexpected note_off on channel, note', channel, note)
+        if method == 0xE0:
+            self.record_automation(method, 0, ((value << 7) | control) - 8192, tick)
+        elif method == 0xD0:
+            self.record_automation(method, 0, control, tick)
+        elif method in AUTOMATION_KINDS:
+            self.record_automation(method, control, value, tick)
        
     def draw_live_notes(self):
         for note in self.live_notes_dict.values():
@@ -222,23 +711,103 @@ class Track:
             note.set_end(tick)
         self.live_notes_dict = {}
 
-    def x_to_ms(self, x):
-        """Map a touch x back to time in ms."""
+    def x_to_tick(self, x):
+        """Map a touch x back to time in ticks."""
         global app
-        return (x - self.x) * app.ms_per_px + app.x_offset_ms
-
-    def load_notes_from_list(self, notes):
-        self.clear_notes()  # Allows undo
-        self.notes = [SeqNote.from_list(n) for n in notes]
-        self.draw()
+        return (x - self.x) * app.ticks_per_px + app.x_offset_tick
+
+    def y_to_note(self, y):
+        """Map a touch y back to a note number, as SeqNote.draw lays them out."""
+        return 29 + (120 - (y - self.y)) // 2
+
+    def index_of(self, note):
+        """Where note is in self.notes."""
+        i = _first_note_at(self.notes, note.on_tick)
+        while self.notes[i] is not note:
+            i += 1
+        return i
+
+    def load_notes_from_ms_list(self, notes):
+        """Load notes from as_list()-style params with times in ms, as in old JSON saves."""
+        new_notes = []
+        for params in notes:
+            note = SeqNote.from_list(params)
+            note.on_tick = round(app.tempo_map.ms_to_tick(note.on_tick))
+            if note.off_tick is not None:
+                note.off_tick = round(app.tempo_map.ms_to_tick(note.off_tick))
+            new_notes.append(note)
+        self.insert_notes(0, sorted(new_notes, key=lambda n: n.on_tick))
 
     def get_notes_as_list(self):
         return [n.as_list() for n in self.notes]
 
 
+# Transforms for Track.edit_notes().  Each returns a function mapping a
+# SeqNote to its edited copy; combine them with chain().
+
+def _copy_note(note, tick=None, note_number=None, vel=None, duration=None):
+    old_duration = None if note.off_tick is None else note.off_tick - note.on_tick
+    return SeqNote(note.note if note_number is None else note_number,
+                   note.vel if vel is None else vel,
+                   note.on_tick if tick is None else tick,
+                   note.channel,
+                   old_duration if duration is None else duration)
+
+def chain(*transforms):
+    """Apply several transforms in one pass."""
+    def transform(note):
+        for t in transforms:
+            note = t(note)
+        return note
+    return transform
+
+def quantize(grid_ticks=TICKS_PER_BEAT // 4, strength=1.0, swing=0.0):
+    """Move note starts strength of the way to the nearest grid line.
+
+    swing (0 to 0.5) delays every second grid line by that fraction of a
+    grid step.  Durations are kept.
+    """
+    def grid_line(k):
+        return k * grid_ticks + (swing * grid_ticks if k % 2 else 0)
+    def transform(note):
+        k = round(note.on_tick / grid_ticks)
+        target = min((grid_line(j) for j in (k - 1, k, k + 1)), key=lambda line: abs(line - note.on_tick))
+        return _copy_note(note, tick=max(0, round(note.on_tick + strength * (target - note.on_tick))))
+    return transform
+
+def transpose(semitones):
+    def transform(note):
+        return _copy_note(note, note_number=min(127, max(0, note.note + semitones)))
+    return transform
+
+def scale_velocity(scale=1.0, compress=0.0, center=64):
+    """Multiply velocities by scale, then pull them compress of the way to center."""
+    def transform(note):
+        vel = note.vel * scale
+        vel += (center - vel) * compress
+        return _copy_note(note, vel=min(127, max(1, round(vel))))
+    return transform
+
+def time_stretch(factor, anchor_tick=0):
+    """Scale note starts (from anchor_tick) and durations by factor."""
+    def transform(note):
+        duration = None if note.off_tick is None else round((note.off_tick - note.on_tick) * factor)
+        return _copy_note(note, tick=max(0, round(anchor_tick + (note.on_tick - anchor_tick) * factor)),
+                          duration=duration)
+    return transform
+
+def humanize(tick_range=TICKS_PER_BEAT // 48, vel_range=8):
+    """Nudge starts and velocities randomly by up to +/- the ranges."""
+    def transform(note):
+        return _copy_note(note, tick=max(0, note.on_tick + random.randint(-tick_range, tick_range)),
+                          vel=min(127, max(1, note.vel + random.randint(-vel_range, vel_range))))
+    return transform
+
+
 # Metronome plays during record
 class Metronome:
 
+    # period is in AMY sequencer ticks, i.e. 48 per beat.
     def __init__(self, osc=amy.AMY_OSCS - 1, period=48, meter=4):
         self.osc = osc
         self.period = period
@@ -246,15 +815,20 @@ class Metronome:
         self.tempo = 108
         amy.send(osc=self.osc, wave=amy.SINE, bp0='10,1,10,1,10,0,0,0')
 
-    def ms_to_tick(self, ms):
-        ticks_per_beat = 48
-        ms_per_tempo_tick = 60000 / self.tempo / ticks_per_beat
-        return round(ms / ms_per_tempo_tick)
+    def bar_ticks(self):
+        """Length of a bar in our (not AMY's) ticks."""
+        return self.meter * TICKS_PER_BEAT
+
+    def set_tempo(self, bpm):
+        """Set the rate of AMY's sequencer, which clocks the metronome."""
+        self.tempo = bpm
+        amy.send(tempo=bpm)
 
-    def start(self, offset_ms=0):
+    def start(self, offset_tick=0):
         total_period = self.period * self.meter
+        self.set_tempo(app.tempo_map.bpm_at(offset_tick))
         # Figure where to play downbeat relative to playhead offset.
-        offset = -self.ms_to_tick(offset_ms)
+        offset = -round(offset_tick * self.period / TICKS_PER_BEAT)
         amy.send(osc=self.osc, vel=1, note=72, sequence='%d,%d,0' % ((offset) % total_period,  total_period))
         for i in range(1, self.meter):
               amy.send(osc=self.osc, vel=1, note=60, sequence='%d,%d,%d' % (
@@ -267,99 +841,960 @@ class Metronome:
         #amy.send(reset=amy.RESET_SEQUENCER)
 
 
+# How far ahead of AMY's clock the scheduler hands notes to the synths.
+LOOKAHEAD_MS = 100
+
+class AmySynthDest:
+    """Plays notes on an AMY synth.
+
+    Events are collected as AMY wire messages and sent as one block by
+    flush(), rather than one amy.send() each.  Pitch bend goes to AMY too,
+    for this synth only; other controllers go to control_change_fn(control,
+    value), as in polyvoice, once they're due.
+    """
+
+    def __init__(self, amy_synth, control_change_fn=None):
+        self.amy_synth = amy_synth
+        self.control_change_fn = control_change_fn
+        self.messages = []
+        # Heap of (amy_ms, control, value) for control_change_fn.
+        self.controls = []
+
+    def note_on(self, note, vel, time):
+        self.messages.append(amy.message(synth=self.amy_synth, note=note, vel=vel, time=round(time)))
+
+    def note_off(self, note, time):
+        self.messages.append(amy.message(synth=self.amy_synth, note=note, vel=0, time=round(time)))
+
+    def control(self, kind, controller, value, time):
+        if kind == 0xE0:
+            self.messages.append(amy.message(synth=self.amy_synth, pitch_bend=value / 8192, time=round(time)))
+        elif kind == 0xB0 and self.control_change_fn:
+            heapq.heappush(self.controls, (time, controller, value))
+
+    def flush(self, amy_ms):
+        if self.messages:
+            # Each message ends with its own 'Z', so they can go together.
+            amy.send_raw(''.join(self.messages))
+            self.messages = []
+        while self.controls and self.controls[0][0] <= amy_ms:
+            _, controller, value = heapq.heappop(self.controls)
+            self.control_change_fn(controller, value)
+
+    def stop(self):
+        self.messages = []
+        self.controls = []
+
+
+def synth_control_change_fn(synth):
+    """A control_change(control, value) that plays CC lanes on synth, or None.
+
+    Synths with their own control_change (as polyvoice's have) get every
+    controller; otherwise the sustain pedal is all that can be played.
+    """
+    if hasattr(synth, 'control_change'):
+        return synth.control_change
+    if hasattr(synth, 'sustain'):
+        def control_change(control, value):
+            if control == 64:
+                synth.sustain(value >= 64)
+        return control_change
+    return None
+
+
+class MidiOutDest:
+    """Plays notes out of the MIDI port on a channel (1-16).
+
+    MIDI has no timestamps, so events wait here until they're due;
+    each flush() writes everything due as one buffer.
+    """
+
+    # No AMY synth to hand loops to.
+    amy_synth = None
+
+    def __init__(self, channel):
+        self.channel = channel
+        # Heap of (amy_ms, status, data1, data2), data2 -1 for two-byte messages.
+        self.queue = []
+
+    def note_on(self, note, vel, time):
+        heapq.heappush(self.queue, (time, 0x90 | (self.channel - 1), note, max(1, round(vel * 127))))
+
+    def note_off(self, note, time):
+        heapq.heappush(self.queue, (time, 0x80 | (self.channel - 1), note, 0))
+
+    def control(self, kind, controller, value, time):
+        status = kind | (self.channel - 1)
+        if kind == 0xE0:
+            value += 8192
+            heapq.heappush(self.queue, (time, status, value & 0x7f, value >> 7))
+        elif kind == 0xD0:
+            # Channel aftertouch has just the one data byte.
+            heapq.heappush(self.queue, (time, status, value, -1))
+        else:
+            heapq.heappush(self.queue, (time, status, controller, value))
+
+    def flush(self, amy_ms):
+        queue = self.queue
+        if not queue or queue[0][0] > amy_ms:
+            return
+        buffer = bytearray()
+        while queue and queue[0][0] <= amy_ms:
+            _, status, data1, data2 = heapq.heappop(queue)
+            buffer.extend(bytes((status, data1, data2)) if data2 >= 0 else bytes((status, data1)))
+        tulip.midi_out(buffer)
+
+    def stop(self):
+        self.queue = []
+        # All Notes Off.
+        tulip.midi_out(bytes((0xB0 | (self.channel - 1), 123, 0)))
+
+
+class NoteRouter:
+    """Counts which tracks are holding each note on each destination.
+
+    When tracks share a destination, a note-on for a note that's already sounding
+    there isn't sent again, and a note-off is only sent once the last track
+    holding the note lets go, so one track can't cut off another's note.
+    Events must come in time order.
+    """
+
+    def __init__(self):
+        # (dest, note) -> number of tracks holding it.
+        self.counts = {}
+
+    def reset(self):
+        self.counts = {}
+
+    def note_on(self, track, note, vel, time):
+        key = (track.dest, note)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if count == 0:
+            track.dest.note_on(note, vel, time=time)
+
+    def note_off(self, track, note, time):
+        key = (track.dest, note)
+        count = self.counts.get(key, 0) - 1
+        if count > 0:
+            self.counts[key] = count
+            return
+        self.counts.pop(key, None)
+        track.dest.note_off(note, time=time)
+
+
+class Scheduler:
+    """Hands notes to the synths a short lookahead ahead of playback.
+
+    Each track has a cursor into its notes.  service(), called every frame,
+    moves the notes starting within LOOKAHEAD_MS of AMY's clock into a heap
+    of events, then passes those due within the lookahead, in time order,
+    through a NoteRouter to the tracks' destinations, and flushes each
+    destination once.  Note-offs wait in the heap until they come within
+    the lookahead too.  Automation lanes are read over the same span, sending
+    only values that change.  With a loop, the cursors jump back to the loop
+    start once the lookahead reaches the loop end.
+    """
+
+    # Event kinds.  Controls sort first so a note starts with its bend in
+    # place, then note-offs so a repeated note ends before it restarts.
+    CONTROL = 0
+    OFF = 1
+    ON = 2
+
+    def __init__(self):
+        self.running = False
+        self.tracks = []
+        # The tracks' distinct destinations.
+        self.dests = []
+        self.cursors = []
+        # (start_tick, end_tick) to repeat, or None.
+        self.loop = None
+        # Heap of (amy_ms, kind, track_index, note, vel for ON or on_amy_ms for OFF),
+        # or (amy_ms, CONTROL, track_index, lane_key, value).
+        self.events = []
+        # Lanes have been read up to here.
+        self.lane_tick = 0
+        # Notes starting before this tick have been queued.
+        self.scheduled_tick = 0
+        # (track_index, lane_key) -> last value sent.
+        self.lane_values = {}
+        # (track_index, lane_key) -> (lane, lane.deltas, cursor) where the
+        # lane was read up to; stale once the lane or its points are replaced.
+        self.lane_cursors = {}
+        self.router = NoteRouter()
+        # AMY time = song ms + base_ms; moves on a loop length each cycle.
+        self.base_ms = 0
+
+    def start(self, tracks, start_ms, loop=None, amy_ms=0):
+        """Play tracks from song time start_ms at AMY time amy_ms."""
+        self.tracks = tracks
+        self.dests = []
+        for track in tracks:
+            if track.dest not in self.dests:
+                self.dests.append(track.dest)
+        self.loop = loop
+        self.events = []
+        self.router.reset()
+        self.running = True
+        self.seek(start_ms, amy_ms)
+
+    def stop(self):
+        self.running = False
+        self.events = []
+        self.router.reset()
+        for dest in self.dests:
+            dest.stop()
+
+    def _flush(self, amy_ms):
+        for dest in self.dests:
+            dest.flush(amy_ms)
+
+    def _cut(self, keep, amy_ms):
+        """Send the pending note-offs that keep() rejects straight away, and forget them."""
+        kept = []
+        for event in self.events:
+            if event[1] != self.OFF or keep(event):
+                kept.append(event)
+            else:
+                # A note-on still queued in AMY gets its note-off right behind it.
+                self.router.note_off(self.tracks[event[2]], event[3], time=max(amy_ms, event[4]))
+        heapq.heapify(kept)
+        self.events = kept
+
+    def mute_track(self, track, amy_ms):
+        """Silence what track has already handed over; service() skips the rest."""
+        if track in self.tracks:
+            index = self.tracks.index(track)
+            self._cut(lambda event: event[2] != index, amy_ms)
+            self._flush(amy_ms)
+
+    def recue_track(self, track):
+        """Find track's cursor again after its notes changed; what's already queued plays on."""
+        if track in self.tracks:
+            self.cursors[self.tracks.index(track)] = _first_note_at(track.notes, self.scheduled_tick)
+
+    def seek(self, start_ms, amy_ms):
+        """Carry on from song time start_ms at AMY time amy_ms, ending the notes sent so far."""
+        self._cut(lambda event: False, amy_ms)
+        self.base_ms = amy_ms - start_ms
+        start_tick = app.tempo_map.ms_to_tick(start_ms)
+        self.cursors = [_first_note_at(track.notes, start_tick) for track in self.tracks]
+        self.scheduled_tick = start_tick
+        self._chase_lanes(start_tick)
+        self.service(amy_ms)
+
+    def _chase_lanes(self, tick):
+        """Send each lane's value at tick, so playback starts with the controls where they'd be."""
+        time = app.tempo_map.tick_to_ms(tick) + self.base_ms
+        self.lane_tick = tick
+        self.lane_values = {}
+        self.lane_cursors = {}
+        for i, track in enumerate(self.tracks):
+            if track.muted:
+                continue
+            for key, lane in track.lanes.items():
+                value = lane.value_at(tick)
+                if value is not None:
+                    heapq.heappush(self.events, (time, self.CONTROL, i, key, value))
+                    self.lane_values[(i, key)] = value
+
+    def _schedule_until(self, end_ms, clip_ms=None):
+        """Queue notes starting before song time end_ms; note-offs no later than clip_ms."""
+        tempo_map = app.tempo_map
+        end_tick = tempo_map.ms_to_tick(end_ms)
+        for i, track in enumerate(self.tracks):
+            notes = track.notes
+            cursor = self.cursors[i]
+            while cursor < len(notes) and notes[cursor].on_tick < end_tick:
+                note = notes[cursor]
+                cursor += 1
+                if track.muted:
+                    continue
+                on_ms = tempo_map.tick_to_ms(note.on_tick) + self.base_ms
+                heapq.heappush(self.events, (on_ms, self.ON, i, note.note, note.vel / 127))
+                if note.off_tick is not None:
+                    off_ms = tempo_map.tick_to_ms(note.off_tick)
+                    if clip_ms is not None:
+                        off_ms = min(off_ms, clip_ms)
+                    heapq.heappush(self.events, (off_ms + self.base_ms, self.OFF, i, note.note, on_ms))
+            self.cursors[i] = cursor
+            if track.muted:
+                continue
+            for key, lane in track.lanes.items():
+                read = self.lane_cursors.get((i, key))
+                if read is not None and read[0] is lane and read[1] is lane.deltas:
+                    cursor = read[2]
+                else:
+                    cursor = lane.cursor_before(self.lane_tick)
+                for tick, value in lane.value_events(self.lane_tick, end_tick, cursor):
+                    if self.lane_values.get((i, key)) != value:
+                        self.lane_values[(i, key)] = value
+                        heapq.heappush(self.events, (tempo_map.tick_to_ms(tick) + self.base_ms, self.CONTROL, i, key, value))
+                self.lane_cursors[(i, key)] = (lane, lane.deltas, lane.cursor_before(end_tick, cursor))
+        self.lane_tick = max(self.lane_tick, end_tick)
+        self.scheduled_tick = end_tick
+
+    def service(self, amy_ms):
+        if not self.running:
+            return
+        horizon_ms = amy_ms + LOOKAHEAD_MS
+        loop = self.loop
+        while loop is not None:
+            loop_start_ms = app.tempo_map.tick_to_ms(loop[0])
+            loop_end_ms = app.tempo_map.tick_to_ms(loop[1])
+            if horizon_ms - self.base_ms < loop_end_ms:
+                break
+            # Finish this pass through the loop and wrap round to the start.
+            self._schedule_until(loop_end_ms, clip_ms=loop_end_ms)
+            self.base_ms += loop_end_ms - loop_start_ms
+            self.cursors = [_first_note_at(track.notes, loop[0]) for track in self.tracks]
+            self._chase_lanes(loop[0])
+        self._schedule_until(horizon_ms - self.base_ms, clip_ms=loop_end_ms if loop else None)
+        router = self.router
+        while self.events and self.events[0][0] < horizon_ms:
+            time, kind, i, note, vel = heapq.heappop(self.events)
+            if kind == self.ON:
+                router.note_on(self.tracks[i], note, vel, time=time)
+            elif kind == self.OFF:
+                router.note_off(self.tracks[i], note, time=time)
+            else:
+                # note is the lane key, vel its value.
+                self.tracks[i].dest.control(note[0], note[1], vel, time=time)
+        self._flush(amy_ms)
+
+
+# Tags for looped notes in AMY's sequencer; the metronome uses the low ones.
+LOOP_FIRST_TAG = 16
+# Most sequencer entries a loop may take before it's left to the Scheduler.
+AMY_SEQUENCE_SLOTS = 128
+# AMY's sequencer ticks per beat.
+AMY_SEQUENCER_PPQ = 48
+
+class AmyLoop:
+    """A loop region played by AMY's sequencer, each track's notes under their own tags.
+
+    AMY's sequencer time 0 is the loop start, so a track can be added to or
+    dropped from a running loop without touching the others'.
+    """
+
+    def __init__(self):
+        self.running = False
+        # track -> list of (tag, note) it has in the sequencer.
+        self.track_tags = {}
+        self.free_tags = []
+
+    def _events(self, track):
+        """(note, vel, on, off) for track's notes in the loop, in sequencer ticks."""
+        period = self.period
+        notes = track.notes
+        events = []
+        for i in range(_first_note_at(notes, self.start_tick), _first_note_at(notes, self.end_tick)):
+            note = notes[i]
+            on = min(round((note.on_tick - self.start_tick) * AMY_SEQUENCER_PPQ / TICKS_PER_BEAT), period - 2)
+            off_tick = self.end_tick if note.off_tick is None else note.off_tick
+            off = round((off_tick - self.start_tick) * AMY_SEQUENCER_PPQ / TICKS_PER_BEAT)
+            # Note-offs land inside the loop, after their note-ons.
+            events.append((note.note, note.vel / 127, on, max(on + 1, min(off, period - 1))))
+        return events
+
+    def _send(self, track, events):
+        tags = self.track_tags.setdefault(track, [])
+        for note, vel, on, off in events:
+            for time, v in ((on, vel), (off, 0)):
+                tag = self.free_tags.pop()
+                amy.send(synth=track.dest.amy_synth, note=note, vel=v, sequence='%d,%d,%d' % (time, self.period, tag))
+                tags.append((tag, note))
+
+    def start(self, tracks, start_tick, end_tick):
+        """Hand the loop [start_tick, end_tick) to AMY, with AMY time 0 as its start.
+
+        Returns False, sending nothing, if AMY can't do it: the loop spans a
+        tempo change, needs more than AMY_SEQUENCE_SLOTS entries, or has a
+        track that doesn't play to an AMY synth or has automation.
+        """
+        tempo_map = app.tempo_map
+        if tempo_map.segment_at(start_tick) != tempo_map.segment_at(end_tick - 1):
+            return False
+        if any(track.dest.amy_synth is None or track.lanes for track in tracks if not track.muted):
+            return False
+        self.start_tick = start_tick
+        self.end_tick = end_tick
+        self.period = round((end_tick - start_tick) * AMY_SEQUENCER_PPQ / TICKS_PER_BEAT)
+        if self.period < 2:
+            return False
+        events = [(track, self._events(track)) for track in tracks if not track.muted]
+        if sum(2 * len(track_events) for _, track_events in events) > AMY_SEQUENCE_SLOTS:
+            return False
+        self.free_tags = list(range(LOOP_FIRST_TAG + AMY_SEQUENCE_SLOTS - 1, LOOP_FIRST_TAG - 1, -1))
+        # AMY's sequencer runs at the metronome's tempo.
+        app.metronome.set_tempo(tempo_map.bpm_at(start_tick))
+        for track, track_events in events:
+            self._send(track, track_events)
+        self.running = True
+        return True
+
+    def add_track(self, track):
+        """Add track's notes to the running loop; False if they don't fit."""
+        events = self._events(track)
+        if track.dest.amy_synth is None or track.lanes or 2 * len(events) > len(self.free_tags):
+            return False
+        self._send(track, events)
+        return True
+
+    def remove_track(self, track, amy_ms=None):
+        """Take track's notes out of the loop, ending any sounding at amy_ms."""
+        tags = self.track_tags.pop(track, [])
+        for tag, _ in tags:
+            amy.send(sequence='0,0,%d' % tag)
+            self.free_tags.append(tag)
+        if amy_ms is not None:
+            for note in set(note for _, note in tags):
+                amy.send(synth=track.dest.amy_synth, note=note, vel=0, time=amy_ms)
+
+    def stop(self, amy_ms=None):
+        for track in list(self.track_tags):
+            self.remove_track(track, amy_ms)
+        self.running = False
+
+
+def start_playback(tracks, start_tick):
+    """Play tracks from start_tick, which becomes AMY time 0."""
+    amy.send(reset=amy.RESET_TIMEBASE)
+    app.clock.invalidate()
+    app.offset_ms = app.tempo_map.tick_to_ms(start_tick)
+    if not app.looping:
+        app.scheduler.start(tracks, app.offset_ms)
+    elif start_tick != app.loop[0] or not app.amy_loop.start(tracks, app.loop[0], app.loop[1]):
+        app.scheduler.start(tracks, app.offset_ms, loop=app.loop)
+
+def stop_playback():
+    app.scheduler.stop()
+    app.amy_loop.stop()
+
+def loop_to_scheduler(song_ms, amy_ms):
+    """Move a loop AMY's sequencer is playing over to the scheduler, from song_ms at amy_ms."""
+    app.amy_loop.stop(amy_ms)
+    app.scheduler.start(app.tracks, song_ms, loop=app.loop, amy_ms=amy_ms)
+    app.offset_ms = song_ms - amy_ms
+
+def mute_changed(track):
+    """Drop a newly-muted track's notes from playback, or pick an unmuted one back up."""
+    amy_ms = tulip.amy_ticks_ms()
+    if app.amy_loop.running:
+        if track.muted:
+            app.amy_loop.remove_track(track, amy_ms)
+        elif not app.amy_loop.add_track(track):
+            loop_to_scheduler(app.tempo_map.tick_to_ms(playing_tick()), amy_ms)
+    elif track.muted:
+        app.scheduler.mute_track(track, amy_ms)
+    # An unmuted track's scheduler cursor has kept moving, so it comes back in by itself.
+
+def seek(song_ms):
+    """Move the playhead to song_ms, re-issuing only the notes after it if we're playing.
+
+    Not while recording: a take's notes are appended in time order.
+    """
+    if app.recording:
+        return
+    if app.playing:
+        amy_ms = tulip.amy_ticks_ms()
+        if app.amy_loop.running:
+            # AMY's sequencer can't jump, so the loop goes over to the scheduler.
+            loop_to_scheduler(song_ms, amy_ms)
+        else:
+            app.scheduler.seek(song_ms, amy_ms)
+            app.offset_ms = song_ms - amy_ms
+    else:
+        amy.send(reset=amy.RESET_TIMEBASE)
+        app.clock.invalidate()
+        app.offset_ms = song_ms
+    move_playhead()
+
+def notes_edited(track, start_tick=0, end_tick=None):
+    """Re-cue playback after track's notes between start_tick and end_tick changed under it.
+
+    The scheduler's cursor for the track is an index into its notes, so it is
+    found again; an AMY loop plays the notes it was compiled from, so if the
+    edit touches the loop the track is recompiled into it, and the loop goes
+    over to the scheduler only if it no longer fits.  Other tracks play on.
+    """
+    if not app.playing:
+        return
+    if app.amy_loop.running:
+        loop_start, loop_end = app.loop
+        if track.muted or start_tick >= loop_end or (end_tick is not None and end_tick < loop_start):
+            return
+        amy_ms = tulip.amy_ticks_ms()
+        app.amy_loop.remove_track(track, amy_ms)
+        if not app.amy_loop.add_track(track):
+            loop_to_scheduler(app.tempo_map.tick_to_ms(playing_tick()), amy_ms)
+    else:
+        app.scheduler.recue_track(track)
+
+def set_loop_to_view():
+    """Loop the whole bars that fill the screen."""
+    bar = app.metronome.bar_ticks()
+    start = int(app.x_offset_tick // bar) * bar
+    num_bars = max(1, round(app.ticks_per_px * screen_width / bar))
+    app.loop = (start, start + num_bars * bar)
+
+def loop_pushed(x):
+    global app
+    if app.playing or app.recording:
+        stop_pushed(x)
+    app.looping = not app.looping
+    color = 0x1c if app.looping else 0x49
+    app.loop_button.button.set_style_bg_color(ui.pal_to_lv(color), ui.lv.PART.MAIN)
+    if app.looping:
+        set_loop_to_view()
+
+
 def quit(app):
     pass
 
 # Got a midi message. parse it and store it
 def midi_received(message):
     global app
+    # Stamp arrival before anything else, so time spent below isn't recorded as lateness.
+    amy_ms = tulip.amy_ticks_ms()
+    if message[0] >= 0xF8:
+        midi_clock_received(message[0], amy_ms)
+        return
+    if app.calibration is not None and app.calibration.received(message, amy_ms):
+        return
     if(app.recording):
-        tick = tulip.amy_ticks_ms() + app.offset_ms
+        tick = round(app.tempo_map.ms_to_tick(amy_ms + app.offset_ms - app.latency.compensation_ms()))
         if app.current_track is not None:
-            app.current_track.consume_midi_event(message, tick)
-            update_seq_position_bar()
+            # Compensation can reach back before the take; keep its notes after the ones it kept.
+            app.current_track.consume_midi_event(message, max(tick, app.current_track.take_start_tick))
 
 
-def move_playhead():
+def midi_clock_received(status, amy_ms):
+    """Follow an external sequencer's MIDI clock and transport."""
+    clock = app.midi_clock
+    if not clock.message(status, amy_ms):
+        return
+    if status == midiclock.START or status == midiclock.CONTINUE:
+        if app.playing or app.recording:
+            return
+        if status == midiclock.START:
+            rtz_pushed(None)
+        bpm = clock.bpm()
+        if bpm is not None:
+            # Play at the clock's tempo; after that, only the metronome follows it.
+            tempo_map = app.tempo_map
+            tempo_map.set_tempo(round(bpm, 1), tempo_map.ticks[tempo_map.segment_at(app.playhead_tick)])
+            unjournaled_edit()
+        play_pushed(None)
+    elif status == midiclock.STOP:
+        if app.playing or app.recording:
+            stop_pushed(None)
+
+
+LATENCY_FILENAME = 'dpweseq_latency.json'
+# Print each take's frame gaps when it stops.  app.latency.report() shows the
+# last take's on demand.
+REPORT_TAKE_FRAME_GAPS = False
+
+class LatencyHistogram:
+    """Counts of delays in 1 ms bins; the last bin holds anything longer."""
+
+    def __init__(self, max_ms=100):
+        self.counts = array.array('H', [0] * (max_ms + 1))
+        self.total = 0
+        self.max_ms = 0
+
+    def add(self, ms):
+        ms = max(0, int(ms))
+        bin = min(ms, len(self.counts) - 1)
+        if self.counts[bin] < 0xFFFF:
+            self.counts[bin] += 1
+        self.total += 1
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p):
+        """Smallest delay that at least p percent of samples are within."""
+        want = self.total * p / 100
+        seen = 0
+        for ms, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= want:
+                return ms
+        return 0
+
+    def report(self, name):
+        if not self.total:
+            return '%s: no samples' % name
+        return '%s: n=%d p50=%dms p90=%dms p99=%dms max=%dms' % (
+            name, self.total, self.percentile(50), self.percentile(90),
+            self.percentile(99), self.max_ms)
+
+
+class Latency:
+    """How late played notes reach the recorder, and the histograms measuring it.
+
+    input_ms is MIDI-in to midi_received, measured by loopback calibration.
+    output_ms is AMY's time from rendering to the speaker, set by hand in
+    LATENCY_FILENAME; a player keeping time with the metronome hears it that
+    late, so it's compensated for too.
+    """
+
+    def __init__(self):
+        self.input_ms = 0
+        self.output_ms = 0
+        # Round trips from the last calibration.
+        self.loopback = LatencyHistogram()
+        # Gaps between frame callbacks during the last take.  MIDI callbacks
+        # queue up behind a long frame, so this shows when input was held up.
+        self.frame_gaps = LatencyHistogram()
+        self.last_frame_ms = None
+
+    def compensation_ms(self):
+        return self.input_ms + self.output_ms
+
+    def load(self):
+        try:
+            with open(LATENCY_FILENAME, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.input_ms = saved.get('input_ms', 0)
+        self.output_ms = saved.get('output_ms', 0)
+
+    def save(self):
+        with open(LATENCY_FILENAME, 'w') as f:
+            json.dump({'input_ms': self.input_ms, 'output_ms': self.output_ms}, f)
+
+    def start_take(self):
+        self.frame_gaps = LatencyHistogram()
+        self.last_frame_ms = None
+
+    def frame(self, amy_ms):
+        if self.last_frame_ms is not None:
+            self.frame_gaps.add(amy_ms - self.last_frame_ms)
+        self.last_frame_ms = amy_ms
+
+    def report(self):
+        print(self.loopback.report('loopback'))
+        print(self.frame_gaps.report('frame gaps'))
+        print('compensation: input %dms + output %dms' % (self.input_ms, self.output_ms))
+
+
+# Loopback calibration sends probe notes out of MIDI out, which must be cabled
+# to MIDI in, and times their return.  Probes are note 0 on channel 16.
+CALIBRATION_STATUS = 0x9F
+CALIBRATION_NOTE = 0
+CALIBRATION_PROBES = 16
+CALIBRATION_INTERVAL_MS = 100
+CALIBRATION_TIMEOUT_MS = 500
+
+class LoopbackCalibration:
+    """Measure input latency one probe at a time, stepped from frame_cb."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.histogram = LatencyHistogram()
+        self.sent = 0
+        self.lost = 0
+        self.sent_ms = None
+        self.next_ms = tulip.amy_ticks_ms()
+
+    def done(self):
+        return self.sent >= CALIBRATION_PROBES and self.sent_ms is None
+
+    def step(self, amy_ms):
+        if self.sent_ms is not None:
+            if amy_ms - self.sent_ms > CALIBRATION_TIMEOUT_MS:
+                self.lost += 1
+                self.sent_ms = None
+            return
+        if self.sent < CALIBRATION_PROBES and amy_ms >= self.next_ms:
+            self.sent_ms = tulip.amy_ticks_ms()
+            tulip.midi_out(bytes([CALIBRATION_STATUS, CALIBRATION_NOTE, 1]))
+            self.sent += 1
+            self.next_ms = amy_ms + CALIBRATION_INTERVAL_MS
+
+    def received(self, message, amy_ms):
+        """Take a returning probe; False for anything else."""
+        if len(message) < 3 or message[0] != CALIBRATION_STATUS or message[1] != CALIBRATION_NOTE:
+            return False
+        if message[2] and self.sent_ms is not None:
+            self.histogram.add(amy_ms - self.sent_ms)
+            self.sent_ms = None
+            tulip.midi_out(bytes([CALIBRATION_STATUS, CALIBRATION_NOTE, 0]))
+        return True
+
+    def finish(self):
+        """Adopt the result; False if no probe came back."""
+        self.latency.loopback = self.histogram
+        if not self.histogram.total:
+            print('latency calibration: no probes returned; is MIDI out cabled to MIDI in?')
+            return False
+        # Each probe crossed the MIDI interface twice; charge half to input.
+        self.latency.input_ms = self.histogram.percentile(50) // 2
+        self.latency.save()
+        if self.lost:
+            print('latency calibration: %d probes lost' % self.lost)
+        self.latency.report()
+        return True
+
+def calibrate_pushed(x):
     global app
-    app.playhead_ms = tulip.amy_ticks_ms() + app.offset_ms
+    if app.playing or app.recording or app.calibration is not None:
+        return
+    app.calibration = LoopbackCalibration(app.latency)
+
+def calibration_step(amy_ms):
+    app.calibration.step(amy_ms)
+    if app.calibration.done():
+        app.calibration.finish()
+        app.calibration = None
+
+
+# The playhead follows AMY's clock predicted from the system clock, which is
+# read against AMY's again every this many frames.
+PLAYHEAD_RESYNC_FRAMES = 30
+
+class PlayheadClock:
+    """AMY's ms, predicted between occasional reads of tulip.amy_ticks_ms().
+
+    AMY's clock moves in audio-block steps, so reading it every frame jitters
+    the playhead as well as costing a call; tulip.ticks_ms() runs smoothly.
+    """
+
+    def __init__(self):
+        self.offset_ms = 0
+        self.frames = PLAYHEAD_RESYNC_FRAMES
+
+    def invalidate(self):
+        """AMY's timebase was reset; read it again on the next frame."""
+        self.frames = PLAYHEAD_RESYNC_FRAMES
+
+    def now(self):
+        if self.frames >= PLAYHEAD_RESYNC_FRAMES:
+            self.offset_ms = tulip.amy_ticks_ms() - tulip.ticks_ms()
+            self.frames = 0
+        self.frames += 1
+        return tulip.ticks_ms() + self.offset_ms
+
+
+def now_tick(amy_ms=None):
+    """The sequence position AMY has reached (or reaches at amy_ms), in ticks."""
+    if amy_ms is None:
+        amy_ms = tulip.amy_ticks_ms()
+    return round(app.tempo_map.ms_to_tick(amy_ms + app.offset_ms))
+
+def playing_tick(amy_ms=None):
+    """The tick being played now, allowing for wrapping round a loop."""
+    tick = now_tick(amy_ms)
+    if app.playing and app.looping and tick >= app.loop[1]:
+        tick = app.loop[0] + (tick - app.loop[0]) % (app.loop[1] - app.loop[0])
+    return tick
+
+def move_playhead(amy_ms=None):
+    global app
+    app.playhead_tick = playing_tick(amy_ms)
     for track in app.tracks:
-        track.move_playhead(app.playhead_ms)
+        track.move_playhead(app.playhead_tick)
+
 
+# Redraw a dirty position bar only every this many frames.
+POSITION_BAR_FRAMES = 15
 
 # called every frane
 def frame_cb(x):
     global app
+    if app.loader is not None:
+        app.loader.step()
+    if app.calibration is not None:
+        calibration_step(tulip.amy_ticks_ms())
     if(app.playing or app.recording):
-        move_playhead()
-        #if(app.playing and app.playhead_ms > app.last_ms):
+        amy_ms = app.clock.now()
+        if app.recording:
+            app.latency.frame(amy_ms)
+        app.scheduler.service(amy_ms)
+        move_playhead(amy_ms)
+        # Keep the metronome's clock following tempo changes, or an external clock.
+        # (Only while recording: AMY's tempo also clocks a loop it's playing.)
+        bpm = app.tempo_map.bpm_at(app.playhead_tick)
+        if app.recording and app.midi_clock.playing and app.midi_clock.bpm() is not None:
+            bpm = round(app.midi_clock.bpm(), 1)
+        if bpm != app.metronome.tempo:
+            app.metronome.set_tempo(bpm)
+        if app.recording:
+            # Flush the journal at each bar line.
+            bar = app.playhead_tick // app.metronome.bar_ticks()
+            if bar != app.journal_bar:
+                app.journal_bar = bar
+                app.journal.flush()
+        app.frame_count += 1
+        if app.position_bar_dirty and app.frame_count % POSITION_BAR_FRAMES == 0:
+            update_seq_position_bar()
+        #if(app.playing and app.playhead_tick > app.last_tick):
         #    app.playing = False
 
+# Color for the note being dragged.
+DRAG_COLOR = 255
+# A touch this close (in px) to a note's end drags the end rather than the note.
+RESIZE_GRAB_PX = 6
+
+class NoteDrag:
+    """A note picked up by touch, being moved (or resized) until the touch lifts."""
+
+    def __init__(self, track, note, x, y):
+        self.track = track
+        self.note = note
+        self.x = x
+        self.y = y
+        self.resize = (note.off_tick is not None
+                       and abs(x - (track.x + _tick_to_x(note.off_tick))) <= RESIZE_GRAB_PX)
+        # Take it out of the track while it's moving; touch_up() puts it back.
+        self.index = track.index_of(note)
+        track.delete_notes(self.index, self.index + 1)
+        self.moved = note
+        self.draw()
+
+    def _span(self, note):
+        return note.on_tick, note.on_tick if note.off_tick is None else note.off_tick
+
+    def span(self):
+        """The ticks the note covered before the drag and covers now."""
+        old_start, old_end = self._span(self.note)
+        new_start, new_end = self._span(self.moved)
+        return min(old_start, new_start), max(old_end, new_end)
+
+    def draw(self):
+        self.moved.draw(base_x=self.track.x, base_y=self.track.y, color=DRAG_COLOR)
+
+    def touch_move(self, x, y):
+        old_start, old_end = self._span(self.moved)
+        dtick = round((x - self.x) * app.ticks_per_px)
+        if self.resize:
+            duration = max(1, self.note.off_tick - self.note.on_tick + dtick)
+            self.moved = _copy_note(self.note, duration=duration)
+        else:
+            note_number = min(127, max(0, self.note.note + (self.y - y) // 2))
+            self.moved = _copy_note(self.note, tick=max(0, self.note.on_tick + dtick), note_number=note_number)
+        new_start, new_end = self._span(self.moved)
+        # Repaint just where the note was and where it is now.
+        self.track.draw_range(min(old_start, new_start), max(old_end, new_end))
+        self.draw()
+
+    def touch_up(self):
+        """Put the edited note back into the track as one undo step."""
+        track = self.track
+        index = _first_note_at(track.notes, self.moved.on_tick)
+        track.insert_notes(index, [self.moved])
+        if self.moved is not self.note:
+            app.undo.begin()
+            app.undo.add_delta(track, self.index, [self.note], False)
+            app.undo.add_delta(track, index, [self.moved], True)
+            app.undo.commit()
+            unjournaled_edit()
+        track.draw_range(*self._span(self.moved))
+
+def track_at(x, y):
+    for track in app.tracks:
+        if track.y <= y < track.y + track.h and x >= track.x:
+            return track
+    return None
+
+def edit_touch(x, y, up):
+    """Touch handling in edit mode: pick up, drag and drop notes."""
+    global app
+    if app.drag is None:
+        track = track_at(x, y)
+        # Notes can't move under a take being recorded.
+        if up or track is None or app.recording:
+            return
+        finish_loading()
+        note = track.hit_index.hit(track.x_to_tick(x), track.y_to_note(y),
+                                   slop_ticks=RESIZE_GRAB_PX * app.ticks_per_px)
+        if note is not None:
+            app.drag = NoteDrag(track, note, x, y)
+            # The note is out of the track until it's dropped.
+            notes_edited(track, *app.drag.span())
+        return
+    app.drag.touch_move(x, y)
+    if up:
+        drag = app.drag
+        drag.touch_up()
+        app.drag = None
+        notes_edited(drag.track, *drag.span())
+
+def edit_mode_pushed(x):
+    global app
+    app.editing = not app.editing
+    color = 0x1c if app.editing else 0x49
+    app.edit_button.button.set_style_bg_color(ui.pal_to_lv(color), ui.lv.PART.MAIN)
+
 def touch_cb(up):
     global app
     (x,y,_,_,_,_) = tulip.touch()
+    if app.editing and (app.drag is not None or track_at(x, y) is not None):
+        edit_touch(x, y, up)
+        return
     # is this a click on the sequence or the position bar?
-    update = False
+    seek_ms = None
     top_of_tracks = app.tracks[0].y
     bottom_of_tracks = app.tracks[-1].y + app.tracks[-1].h
     if y >= top_of_tracks and y < bottom_of_tracks and x >= app.tracks[0].x:
         # Within the track stripes, move the playhead.
-        app.offset_ms = app.tracks[0].x_to_ms(x)
-        update = True
+        seek_ms = app.tempo_map.tick_to_ms(app.tracks[0].x_to_tick(x))
     if y > bottom_of_tracks: # position bar
-        pos_ms = app.last_ms * (x / screen_width)
+        pos_tick = app.last_tick * (x / screen_width)
         # only move view if this click is outside of view
-        if(not (pos_ms >= app.x_offset_ms and pos_ms < app.x_offset_ms + (app.ms_per_px*screen_width))):
-            app.offset_ms = pos_ms
-            app.x_offset_ms = pos_ms 
-            app.playhead_ms = pos_ms
+        if(not (pos_tick >= app.x_offset_tick and pos_tick < app.x_offset_tick + (app.ticks_per_px*screen_width))):
+            app.x_offset_tick = pos_tick
+            if not app.recording:
+                seek_ms = app.tempo_map.tick_to_ms(pos_tick)
+                app.playhead_tick = pos_tick
             draw()
-            update = True
-    if(update):
-        # Reset time and also upcoming events
-        amy.send(reset=amy.RESET_TIMEBASE + amy.RESET_EVENTS)
-        move_playhead()
-        if(app.playing): # reschedule events if playing
-            for track in app.tracks:
-                track.schedule_notes(app.offset_ms)
-
+    if seek_ms is not None:
+        seek(seek_ms)
 
 def rec_pushed(x):
     global app
+    finish_loading()
     if app.playing or app.recording:
         # Pressing record during play/record does stop.
         stop_pushed(x)
     else:
         # Start recording
-        amy.send(reset=amy.RESET_TIMEBASE)
         app.playing = False
         app.recording = True
-        # We're about to record, clear the notes in the record-to track
+        # We're about to record, clear the notes in the record-to track.
+        # The clear and the new take are undone together.
+        app.undo.begin()
         if app.current_track:
-            app.current_track.clear_notes(app.playhead_ms)
+            journal_take_start(app.current_track, app.playhead_tick)
+            app.current_track.start_take(app.playhead_tick)
             # start recording from playhead position
-        app.offset_ms = app.playhead_ms
+        app.latency.start_take()
+        amy.send(reset=amy.RESET_TIMEBASE)
+        app.clock.invalidate()
+        app.offset_ms = app.tempo_map.tick_to_ms(app.playhead_tick)
         # Set the other tracks playing
-        for track in app.tracks:
-            if track != app.current_track:
-                track.schedule_notes(app.offset_ms)
-                # Start the metronome
-        app.metronome.start(app.offset_ms)
+        app.scheduler.start([track for track in app.tracks if track != app.current_track], app.offset_ms)
+        # Start the metronome
+        app.metronome.start(app.playhead_tick)
 
 
 def play_pushed(x):
     global app
+    finish_loading()
     if app.playing or app.recording:
         # Pressing play during rec/play does stop.
         stop_pushed(x)
     else:
         # Start playing
-        amy.send(reset=amy.RESET_TIMEBASE)
         app.recording = False
         app.playing = True
-        app.offset_ms = app.playhead_ms
-        for track in app.tracks:
-            track.schedule_notes(app.offset_ms)
+        if app.looping:
+            # Looped playback starts from the top of the loop.
+            app.playhead_tick = app.loop[0]
+        start_playback(app.tracks, app.playhead_tick)
 
 def rtz_pushed(x):
     global app
@@ -367,57 +1802,375 @@ def rtz_pushed(x):
         # Pressing play during rec/play does stop.
         stop_pushed(x)
     amy.send(reset=amy.RESET_TIMEBASE)
+    app.clock.invalidate()
     app.offset_ms = 0
-    app.x_offset_ms = 0
-    app.playhead_ms = 0
+    app.x_offset_tick = 0
+    app.playhead_tick = 0
     move_playhead()
     draw()
 
 def stop_pushed(x):
     global app, all_active_channels
+    was_recording = app.recording
     app.playing = False
     app.recording = False
     # Stop any current-sounding notes.
-    tick = tulip.amy_ticks_ms() + app.offset_ms
+    tick = now_tick()
     for track in app.tracks:
         track.stop_live_notes(tick)
+    if was_recording:
+        if app.current_track:
+            app.journal.append(app.current_track.index, seqfile.TAKE_END, 0, 0, tick)
+            app.current_track.end_take()
+        app.undo.commit()
+        app.journal.flush()
+        if REPORT_TAKE_FRAME_GAPS:
+            print(app.latency.frame_gaps.report('take frame gaps'))
+    stop_playback()
     # clear any AMY messages in the queue / currently sounding.
     amy.send(reset=amy.RESET_EVENTS)
     amy.send(reset=amy.RESET_ALL_NOTES)
     # Stop the metronome
     app.metronome.stop()
 
+SAVED_FILENAME = 'dpweseq_saved.seq'
+# Older saves are JSON; they're still read if there's no binary save.
+JSON_SAVED_FILENAME = 'dpweseq_saved.json'
+JOURNAL_FILENAME = 'dpweseq_journal.bin'
+
+# The saved sequence is a snapshot plus a journal of the takes recorded since.
+# While app.journal_ok, snapshot + journal reproduce the tracks, so saving
+# only has to flush the journal.  Edits that aren't journaled (undo, redo)
+# clear journal_ok, and the next save or take rewrites the snapshot instead.
+
+def journal_take_start(track, clear_from_tick):
+    if not app.journal_ok:
+        compact()
+    app.journal.append(track.index, seqfile.TAKE_START, 0, 0, clear_from_tick)
+
+def unjournaled_edit():
+    """Note that the tracks have changed in a way the journal can't replay."""
+    app.journal.flush()
+    app.journal_ok = False
+
+def compact():
+    """Fold the journal into a fresh snapshot of all the tracks."""
+    global app
+    finish_loading()
+    seqfile.write_sequence(SAVED_FILENAME + '.tmp', [track.notes for track in app.tracks],
+                           app.tempo_map.segments(), [list(track.lanes.values()) for track in app.tracks])
+    seqfile.replace_file(SAVED_FILENAME + '.tmp', SAVED_FILENAME)
+    app.journal.reset()
+    app.journal_ok = True
+
 def save_pushed(x):
     global app
-    all_notes = {}
-    num_notes = 0
-    for index, track in enumerate(app.tracks):
-        all_notes[index] = track.get_notes_as_list()
-        num_notes += len(all_notes[index])
-    filename = 'dpweseq_saved.json'
-    with open(filename, 'w') as f:
-        json.dump(all_notes, f)
-    #print(num_notes, 'notes saved to', filename)
+    finish_loading()
+    if app.journal_ok:
+        app.journal.flush()
+    else:
+        compact()
 
-def load_pushed(x):
+def _finish_replayed_take(track, tick):
+    track.stop_live_notes(tick)
+    track.end_take()
+    app.undo.commit()
+
+def replay_journal():
+    """Re-apply the takes recorded in the journal since the snapshot."""
     global app
-    filename = 'dpweseq_saved.json'
-    with open(filename, 'r') as f:
-        all_notes = json.load(f)
-    num_notes = 0
+    if seqfile.repair_journal(JOURNAL_FILENAME):
+        print('dpweseq: cut a torn record off the journal')
+    take_track = None
+    unfinished = False
+    tick = 0
+    # Version 1 journals have times in ms.
+    ms_times = seqfile.journal_version(JOURNAL_FILENAME) == 1
+    app.journal.enabled = False
+    for index, status, data1, data2, tick in seqfile.read_journal(JOURNAL_FILENAME):
+        if index >= len(app.tracks):
+            # Not something we wrote; skip it rather than fail to start.
+            continue
+        if ms_times:
+            tick = round(app.tempo_map.ms_to_tick(tick))
+        track = app.tracks[index]
+        if status == seqfile.TAKE_START:
+            if take_track is not None:
+                # A take that never ended (a crash) before this one.
+                _finish_replayed_take(take_track, tick)
+                unfinished = True
+            take_track = track
+            app.undo.begin()
+            track.start_take(tick)
+        elif status == seqfile.TAKE_END:
+            if take_track is not None:
+                _finish_replayed_take(take_track, tick)
+            take_track = None
+        elif take_track is not None and status >= 0x80:
+            track.consume_midi_event(bytes([status, data1, data2]), tick)
+    if take_track is not None:
+        # The journal ends mid-take, e.g. after a crash.
+        _finish_replayed_take(take_track, tick)
+        unfinished = True
+    app.journal.enabled = True
+    if unfinished:
+        # Fold the unfinished take into the snapshot, so the next take's
+        # records don't land inside it.
+        compact()
+
+
+class SequenceLoader:
+    """Fill the tracks from a binary save a few blocks at a time.
+
+    Blocks overlapping the current view are decoded and drawn straight away;
+    frame_cb calls step() to decode the rest in the background.
+    """
+
+    def __init__(self, reader, undoable=True):
+        self.reader = reader
+        self.undoable = undoable
+        view_start = app.x_offset_tick
+        view_end = view_start + app.ticks_per_px * screen_width
+        num_tracks = min(len(reader.blocks), len(app.tracks))
+        # Notes loaded so far from each block, to find where the next one goes.
+        self.loaded = [[0] * len(reader.blocks[t]) for t in range(num_tracks)]
+        visible = []
+        self.pending = []
+        for t in range(num_tracks):
+            for b, (first, last, _, _, _) in enumerate(reader.blocks[t]):
+                if first < view_end and last >= view_start:
+                    visible.append((t, b))
+                else:
+                    self.pending.append((t, b))
+        # pop() takes blocks from the end, so reverse to load in time order.
+        self.pending.reverse()
+        for t, b in visible:
+            self._load(t, b)
+        for t in range(num_tracks):
+            app.tracks[t].draw()
+
+    def _load(self, t, b):
+        try:
+            notes = [SeqNote.from_list(params) for params in self.reader.read_block(t, b)]
+        except ValueError as e:
+            # Lose just this block's notes.
+            print('dpweseq: %s' % e)
+            return
+        if self.reader.version == 1:
+            # Version 1 saves have times in ms.
+            for note in notes:
+                note.on_tick = round(app.tempo_map.ms_to_tick(note.on_tick))
+                if note.off_tick is not None:
+                    note.off_tick = round(app.tempo_map.ms_to_tick(note.off_tick))
+        app.tracks[t].insert_notes(sum(self.loaded[t][:b]), notes)
+        self.loaded[t][b] = len(notes)
+
+    def step(self, num_blocks=4):
+        """Load up to num_blocks more blocks; finish the load if there are none left."""
+        while self.pending and num_blocks > 0:
+            self._load(*self.pending.pop())
+            num_blocks -= 1
+        if not self.pending:
+            self.reader.close()
+            app.loader = None
+            snapshot_loaded(self.undoable)
+
+
+def finish_loading():
+    """Complete any load still running in the background."""
+    if app.loader is not None:
+        app.loader.step(len(app.loader.pending))
+
+def snapshot_loaded(undoable):
+    """Once the snapshot is in the tracks, apply the journal and redraw."""
+    if undoable:
+        for track in app.tracks:
+            if track.notes:
+                app.undo.add_delta(track, 0, list(track.notes), True)
+        app.undo.commit()
+    replay_journal()
+    draw()
+
+def lanes_from_saved(saved_lanes):
+    """Build a track's lanes from SequenceReader.automation entries."""
+    lanes = {}
+    for kind, controller, deltas, values in saved_lanes:
+        lane = AutomationLane(kind, controller)
+        lane.deltas = array.array('l', deltas)
+        lane.values = array.array('h', values)
+        lane.last_tick = sum(deltas)
+        lanes[(kind, controller)] = lane
+    return lanes
+
+def load_session(undoable=True):
+    """Read the snapshot and replay the journal on top of it."""
+    global app
+    finish_loading()
+    app.journal.flush()
+    # Loading all tracks is a single undo step.
+    if undoable:
+        app.undo.begin()
+    for track in app.tracks:
+        track.clear_notes()
+    app.journal_ok = True
+    # A crash mid-save can leave the new snapshot under its temporary name.
+    seqfile.recover_file(SAVED_FILENAME)
+    damaged = False
+    try:
+        reader = seqfile.SequenceReader(SAVED_FILENAME)
+    except OSError:
+        reader = None
+    except ValueError as e:
+        # Corrupt or truncated; start with empty tracks rather than not at all.
+        print('dpweseq: %s' % e)
+        reader = None
+        damaged = True
+    if reader is not None:
+        if reader.tempo_segments:
+            app.tempo_map.set_segments(reader.tempo_segments)
+        for track, saved_lanes in zip(app.tracks, reader.automation):
+            track.replace_lanes(lanes_from_saved(saved_lanes), undoable)
+        app.loader = SequenceLoader(reader, undoable)
+        return
+    all_notes = None
+    if not damaged:
+        try:
+            with open(JSON_SAVED_FILENAME, 'r') as f:
+                all_notes = json.load(f)
+        except OSError:
+            pass
+    if all_notes is None:
+        all_notes = {}
+        app.journal_ok = False
+    for track in app.tracks:
+        track.replace_lanes({}, undoable)
     for index, notes in all_notes.items():
-        app.tracks[int(index)].load_notes_from_list(notes)
-        num_notes += len(notes)
-    #print(num_notes, 'notes read from', filename)
+        app.tracks[int(index)].load_notes_from_ms_list(notes)
+    snapshot_loaded(undoable)
+
+def load_pushed(x):
+    if app.playing or app.recording:
+        stop_pushed(x)
+    load_session()
+
+
+MIDI_FILENAME = 'dpweseq.mid'
+# Ticks per quarter note in exported MIDI files.
+MIDI_DIVISION = 480
+
+def import_midi_file(filename=MIDI_FILENAME):
+    """Replace the tracks with the notes of a type 0 or 1 Standard MIDI File.
+
+    Type 1 tracks that hold notes fill our tracks in order; a type 0 file is
+    split up by MIDI channel instead.  Events are paired into notes as they
+    stream in, and the file's tempo changes become our tempo map.
+    """
+    global app
+    finish_loading()
+    new_notes = [[] for _ in app.tracks]
+    # Which of our tracks each MIDI track (or type 0 channel) goes to, -1 for none.
+    slots = {}
+    # Notes waiting for their note-off, by (slot, channel, note).
+    live_notes = {}
+    tempo_segments = [(0, 60000000 / midifile.DEFAULT_TEMPO)]
+    with open(filename, 'rb') as f:
+        reader = midifile.MidiFileReader(f)
+        for midi_track, events in enumerate(reader.tracks()):
+            for midi_tick, status, data1, data2 in events:
+                tick = midi_tick * TICKS_PER_BEAT // reader.division
+                if status == midifile.META:
+                    # Tempo is in microseconds per beat.
+                    if tick == tempo_segments[-1][0]:
+                        tempo_segments[-1] = (tick, 60000000 / data2)
+                    elif tick > tempo_segments[-1][0]:
+                        tempo_segments.append((tick, 60000000 / data2))
+                    continue
+                method = status & 0xF0
+                if method != 0x90 and method != 0x80:
+                    continue
+                channel = (status & 0x0F) + 1
+                key = channel if reader.format == 0 else midi_track
+                slot = slots.get(key)
+                if slot is None:
+                    slot = len(slots) if len(slots) < len(app.tracks) else -1
+                    slots[key] = slot
+                    if slot < 0:
+                        print('no track left for MIDI track/channel', key)
+                if slot < 0:
+                    continue
+                previous = live_notes.pop((slot, channel, data1), None)
+                if previous is not None:
+                    previous.set_end(tick)
+                if method == 0x90 and data2 > 0:
+                    note = SeqNote(data1, data2, tick, channel)
+                    new_notes[slot].append(note)
+                    live_notes[(slot, channel, data1)] = note
+    app.tempo_map.set_segments(tempo_segments)
+    app.undo.begin()
+    for track, notes in zip(app.tracks, new_notes):
+        track.clear_notes()
+        if notes:
+            track.insert_notes(0, notes)
+            app.undo.add_delta(track, 0, notes, True)
+    app.undo.commit()
+    unjournaled_edit()
     draw()
 
+def export_midi_file(filename=MIDI_FILENAME):
+    """Write the tracks, and the tempo map, as a type 1 Standard MIDI File."""
+    global app
+    finish_loading()
+    with open(filename, 'wb') as f:
+        writer = midifile.MidiFileWriter(f, 1 + len(app.tracks), MIDI_DIVISION)
+        # Conductor track.
+        writer.begin_track()
+        for tick, bpm in app.tempo_map.segments():
+            writer.tempo(tick * MIDI_DIVISION // TICKS_PER_BEAT, int(round(60000000 / bpm)))
+        writer.end_track()
+        for track in app.tracks:
+            writer.begin_track()
+            # Heap of (tick, status, note) note-offs still to write.
+            note_offs = []
+            for note in track.notes:
+                tick = note.on_tick * MIDI_DIVISION // TICKS_PER_BEAT
+                while note_offs and note_offs[0][0] <= tick:
+                    writer.event(*heapq.heappop(note_offs), 0)
+                status = 0x90 | ((note.channel - 1) & 0x0F)
+                writer.event(tick, status, note.note, max(1, note.vel))
+                if note.off_tick is not None:
+                    # Note-off as note-on with zero velocity keeps running status going.
+                    heapq.heappush(note_offs, (note.off_tick * MIDI_DIVISION // TICKS_PER_BEAT, status, note.note))
+            while note_offs:
+                writer.event(*heapq.heappop(note_offs), 0)
+            writer.end_track()
+
+def import_pushed(x):
+    if app.playing or app.recording:
+        stop_pushed(x)
+    import_midi_file()
+
+def export_pushed(x):
+    export_midi_file()
+
 def zoom_changed(x):
     global app
     val = x.get_target_obj().get_value()
-    # set zoom where 0 (left) = 100 ms_per_px and 100 (right) = 5 ms_per_px 
-    app.ms_per_px = max((100 - val), 5)
+    # set zoom where 0 (left) = 100 ticks_per_px and 100 (right) = 5 ticks_per_px
+    app.ticks_per_px = max((100 - val), 5)
     draw()
 
+def tempo_changed(x):
+    """Slider sets the tempo (60-160 BPM) of the tempo segment under the playhead."""
+    global app
+    if app.playing or app.recording:
+        # Everything ahead is already scheduled at the old tempo.
+        stop_pushed(x)
+    val = x.get_target_obj().get_value()
+    tempo_map = app.tempo_map
+    tempo_map.set_tempo(60 + val, tempo_map.ticks[tempo_map.segment_at(app.playhead_tick)])
+    # The tempo map isn't journaled, so the next save rewrites the snapshot.
+    unjournaled_edit()
+
 def activate(app):
     setup_playhead_sprites()
     draw()
@@ -433,17 +2186,39 @@ def setup_playhead_sprites():
     bitmap = bytes([0x55, 0x55, 159] * 40) # just a light blue dotted line (0x55 is alpha), 120px hight, 1 px wide
     tulip.sprite_bitmap(bitmap, 0)
 
+def draw_density_row(track, y, h, span_ticks):
+    """Draw one track's note density across the position bar."""
+    bucket_ticks, counts = track.density.level_for(span_ticks, screen_width)
+    peak = max(counts) if counts else 0
+    if not peak:
+        return
+    px_per_bucket = screen_width * bucket_ticks / span_ticks
+    for i, count in enumerate(counts):
+        if count:
+            x = int(i * px_per_bucket)
+            w = max(1, int((i + 1) * px_per_bucket) - x)
+            shade = DENSITY_COLORS[(count * len(DENSITY_COLORS) - 1) // peak]
+            tulip.bg_rect(x, y, w, h, shade, 1)
+
 def update_seq_position_bar():
     # Draw a box on the bottom to show zoom position
-    ms_per_screen = app.ms_per_px * screen_width
-    if(app.last_ms > ms_per_screen): 
-        screen_use_px = int((ms_per_screen / app.last_ms) * screen_width)
-        seq_position_px = int((app.x_offset_ms / app.last_ms) * screen_width)
+    ticks_per_screen = app.ticks_per_px * screen_width
+    if(app.last_tick > ticks_per_screen): 
+        span_ticks = app.last_tick
+        screen_use_px = int((ticks_per_screen / app.last_tick) * screen_width)
+        seq_position_px = int((app.x_offset_tick / app.last_tick) * screen_width)
     else:
+        span_ticks = ticks_per_screen
         screen_use_px= screen_width
         seq_position_px = 0
     tulip.bg_rect(0, 580, screen_width, 20, 109, 1)
-    tulip.bg_rect(seq_position_px, 580, screen_use_px, 20, 165, 1)
+    # One row per track showing where its notes are.
+    row_h = 20 // len(app.tracks)
+    for i, track in enumerate(app.tracks):
+        draw_density_row(track, 580 + i * row_h, row_h, span_ticks)
+    # Outline, rather than fill, the view box so the density shows through.
+    tulip.bg_rect(seq_position_px, 580, screen_use_px, 20, 165, 0)
+    app.position_bar_dirty = False
 
 # Redraw everything
 def init_tracks():
@@ -453,8 +2228,14 @@ def init_tracks():
     track_y = 60
     track_w = screen_width - track_x
     track_h = screen_height // 5
-    channel = 1  # For now, all tracks drive the Synth on MIDI channel 1.
+    # One destination per synth, so tracks sharing a synth share its note counts.
+    dests = {}
     for i in range(4):
+        # Track i plays the synth on MIDI channel i + 1, if there is one.
+        channel = i + 1 if (i + 1) in midi.config.synth_per_channel else 1
+        if channel not in dests:
+            synth = midi.config.synth_per_channel.get(channel)
+            dests[channel] = AmySynthDest(channel, synth_control_change_fn(synth))
         app.tracks.append(
             Track(
                 i,
@@ -463,8 +2244,7 @@ def init_tracks():
                 w=track_w,
                 h=track_h,
                 bg_color=channel_bg_colors[i],
-                note_on_fn=midi.config.synth_per_channel[channel].note_on,
-                note_off_fn=midi.config.synth_per_channel[channel].note_off,
+                dest=dests[channel],
             )
         )
 
@@ -476,28 +2256,164 @@ def draw():
     update_seq_position_bar()
 
 
-# Undo stack is a list of objects that provide undo() and redo() methods.
-undo_stack = []
-# Which item is the next one to undo (or just beyond the next one to redo).
-undo_position = 0
+# Most notes the undo history may hold before forgetting the oldest edits.
+UNDO_BUDGET_NOTES = 20000
+
+class UndoJournal:
+    """Multi-level undo history of note insertions and deletions.
+
+    Each edit is a list of deltas [track, index, notes, inserted], meaning
+    notes were inserted into (or deleted from) track.notes at index.  An
+    automation change is [track, lane_key, [old_lane, new_lane], None].  The
+    deltas hold the affected SeqNotes themselves, so undo and redo cost
+    O(notes changed) and the history costs memory only for what changed.
+    Once more than budget notes are held, the oldest edits are dropped.
+    """
+
+    def __init__(self, budget=UNDO_BUDGET_NOTES):
+        self.budget = budget
+        self.edits = []
+        # edits[:position] can be undone, edits[position:] redone.
+        self.position = 0
+        self.size = 0
+        # Edit being accumulated between begin() and commit().
+        self.open_edit = None
+
+    def begin(self):
+        """Start grouping subsequent deltas into one edit."""
+        if self.open_edit is None:
+            self.open_edit = []
+
+    def commit(self):
+        """Close the edit started by begin()."""
+        edit, self.open_edit = self.open_edit, None
+        if edit:
+            self._push(edit)
+
+    def add_delta(self, track, index, notes, inserted):
+        delta = [track, index, notes, inserted]
+        if self.open_edit is not None:
+            self.open_edit.append(delta)
+        else:
+            self._push([delta])
+
+    @staticmethod
+    def _edit_size(edit):
+        size = 0
+        for delta in edit:
+            if delta[3] is None:
+                size += 1 + sum(len(lane.values) for lane in delta[2] if lane is not None)
+            else:
+                size += 1 + len(delta[2])
+        return size
+
+    def _push(self, edit):
+        # A new edit discards anything that could have been redone.
+        for old_edit in self.edits[self.position:]:
+            self.size -= self._edit_size(old_edit)
+        del self.edits[self.position:]
+        self.edits.append(edit)
+        self.size += self._edit_size(edit)
+        while self.size > self.budget and len(self.edits) > 1:
+            self.size -= self._edit_size(self.edits.pop(0))
+        self.position = len(self.edits)
+
+    @staticmethod
+    def _apply(delta, forward):
+        track, index, notes, inserted = delta
+        if inserted is None:
+            track.set_lane(index, notes[1] if forward else notes[0])
+        elif inserted == forward:
+            track.insert_notes(index, notes)
+        else:
+            track.delete_notes(index, index + len(notes))
+
+    @staticmethod
+    def _redraw(edit):
+        tracks = []
+        for delta in edit:
+            if delta[0] not in tracks:
+                tracks.append(delta[0])
+        for track in tracks:
+            track.draw()
+        update_seq_position_bar()
+
+    @staticmethod
+    def note_spans(edit):
+        """(track, first_tick, last_tick) for each track whose notes edit changes."""
+        spans = {}
+        for track, _, notes, inserted in edit:
+            if inserted is None or not notes:
+                continue
+            start = min(note.on_tick for note in notes)
+            end = max(note.on_tick if note.off_tick is None else note.off_tick for note in notes)
+            if track in spans:
+                start = min(start, spans[track][0])
+                end = max(end, spans[track][1])
+            spans[track] = (start, end)
+        return [(track, start, end) for track, (start, end) in spans.items()]
+
+    def undo(self):
+        """Undo the last edit, and return it (None if there was none)."""
+        if self.position > 0:
+            self.position -= 1
+            edit = self.edits[self.position]
+            for delta in reversed(edit):
+                self._apply(delta, False)
+            self._redraw(edit)
+            return edit
+        return None
+
+    def redo(self):
+        """Redo the last undone edit, and return it (None if there was none)."""
+        if self.position < len(self.edits):
+            edit = self.edits[self.position]
+            self.position += 1
+            for delta in edit:
+                self._apply(delta, True)
+            self._redraw(edit)
+            return edit
+        return None
+
 
 def undo_pushed(x):
-    global app, undo_stack, undo_position
-    if undo_position < len(undo_stack):
-        undo_stack[undo_position].undo()
-        undo_position += 1
+    global app
+    if app.recording:
+        stop_pushed(x)
+    finish_loading()
+    unjournaled_edit()
+    edit = app.undo.undo()
+    for track, start_tick, end_tick in UndoJournal.note_spans(edit or []):
+        notes_edited(track, start_tick, end_tick)
+
+def edit_pushed(transform):
+    """Apply transform to the record-ready track, within the loop if looping."""
+    global app
+    if app.recording:
+        stop_pushed(None)
+    finish_loading()
+    if app.current_track is None:
+        return
+    unjournaled_edit()
+    if app.looping:
+        app.current_track.edit_notes(transform, app.loop[0], app.loop[1])
+        notes_edited(app.current_track, app.loop[0], app.loop[1])
+    else:
+        app.current_track.edit_notes(transform)
+        notes_edited(app.current_track)
 
-def redo_pushed(x):
-    global app, undo_stack, undo_position
-    if undo_position > 0:
-        undo_position -= 1
-        undo_stack[undo_position].redo()
+def quantize_pushed(x):
+    edit_pushed(quantize())
 
-def add_undo_object(object):
-    """Add a new object to the top of the undo stack."""
-    global undo_stack, undo_position
-    undo_stack = [object] + undo_stack[undo_position:]
-    undo_position = 0
+def redo_pushed(x):
+    global app
+    if app.recording:
+        stop_pushed(x)
+    finish_loading()
+    unjournaled_edit()
+    edit = app.undo.redo()
+    for track, start_tick, end_tick in UndoJournal.note_spans(edit or []):
+        notes_edited(track, start_tick, end_tick)
 
 # from lv_binding_micropython_tulip/lvgl/src/font/lv_symbol_def.h
 #LV_SYMBOL_PLAY = "\xEF\x81\x8B"
@@ -508,31 +2424,65 @@ def run(screen):
     # Since we're using sprites, BG drawing and scrolling, use "game mode"
     app.game = True
 
-    # Where in ms of the sequence the left side of the screen is
-    app.x_offset_ms = 0
+    # Where in ticks of the sequence the left side of the screen is
+    app.x_offset_tick = 0
     # Where the playhead is currently in the sequence, moves during recording/playback
-    app.playhead_ms = 0
+    app.playhead_tick = 0
     # Where the record/play started from, as an offset in ms
     app.offset_ms = 0
-    # The latest note ms
-    app.last_ms = 0
+    # The latest note tick
+    app.last_tick = 0
+    app.tempo_map = TempoMap()
+    app.clock = PlayheadClock()
+    # Incoming MIDI clock, followed for transport and metronome tempo.
+    app.midi_clock = midiclock.MidiClock()
+    app.scheduler = Scheduler()
+    # Loop region as (start_tick, end_tick).
+    app.looping = False
+    # Touch editing mode, and the note being dragged.
+    app.editing = False
+    app.drag = None
+    app.loop = (0, 0)
+    # Input latency compensation, and the calibration measuring it.
+    app.latency = Latency()
+    app.latency.load()
+    app.calibration = None
+    # Plays the loop when it fits in AMY's sequencer.
+    app.amy_loop = AmyLoop()
+    # Position bar needs redrawing to show newly-recorded notes.
+    app.position_bar_dirty = False
+    app.frame_count = 0
 
     app.recording = False
     app.playing = False
     app.tracks = []
+    app.undo = UndoJournal()
+    app.journal = seqfile.JournalWriter(JOURNAL_FILENAME)
+    app.journal_ok = False
+    app.journal_bar = 0
     app.activate_callback = activate
     app.quit_callback = quit
     app.deactivate_callback = deactivate
     app.add(tulip.UIButton(text="O",  bg_color=96, fg_color=255, callback=rec_pushed), x=0, y=0)
     app.add(tulip.UIButton(text="|>", bg_color=48, fg_color=255, callback=play_pushed))
     app.add(tulip.UIButton(text="|<", bg_color=252, fg_color=0, callback=rtz_pushed))
+    app.loop_button = tulip.UIButton(text="Lp", bg_color=0x49, fg_color=255, callback=loop_pushed)
+    app.add(app.loop_button)
     #app.add(tulip.UIButton(text="Stop", bg_color=237, fg_color=0, callback=stop_pushed))
     app.add(tulip.UIButton(text="Lo", bg_color=10, fg_color=0, callback=load_pushed))
     app.add(tulip.UIButton(text="Sa", bg_color=18, fg_color=0, callback=save_pushed))
+    app.add(tulip.UIButton(text="Im", bg_color=14, fg_color=0, callback=import_pushed))
+    app.add(tulip.UIButton(text="Ex", bg_color=22, fg_color=0, callback=export_pushed))
     app.add(tulip.UIButton(text="Un", bg_color=102, fg_color=0, callback=undo_pushed))
     app.add(tulip.UIButton(text="Re", bg_color=134, fg_color=0, callback=redo_pushed))
+    app.add(tulip.UIButton(text="Q", bg_color=166, fg_color=0, callback=quantize_pushed))
+    app.edit_button = tulip.UIButton(text="Ed", bg_color=0x49, fg_color=255, callback=edit_mode_pushed)
+    app.add(app.edit_button)
+    app.add(tulip.UIButton(text="Lt", bg_color=0x6d, fg_color=0, callback=calibrate_pushed))
     app.add(tulip.UISlider(w=200, val=70, bar_color=74, handle_color=208, handle_radius=25, callback=zoom_changed))
-    app.ms_per_px = 30 
+    app.ticks_per_px = 30
+    app.add(tulip.UISlider(w=150, val=app.tempo_map.bpm_at(0) - 60, bar_color=100, handle_color=208,
+                           handle_radius=25, callback=tempo_changed))
 
     init_tracks()
     app.current_track = None
@@ -542,6 +2492,10 @@ def run(screen):
 
     app.metronome = Metronome(period=48, meter=4)
 
+    # Reopen the session where it left off, including any take cut short by a crash.
+    app.loader = None
+    load_session(undoable=False)
+
     app.present()
 
 
@@ -0,0 +1,107 @@
+"""Cooperative timing tasks sharing one asyncio event loop.
+
+Timing-driven parts of a program (the arpeggiator, coalesced controls,
+anything periodic) each run as a task, so none needs its own blocking
+loop.  Works with MicroPython's asyncio (uasyncio) and CPython's.
+
+  tasks = engine.Engine()
+  tasks.add(arpeggiator.task())
+  tasks.every(20, poll_something)
+  tasks.run()  # Blocks, running all the tasks.
+"""
+
+import asyncio
+
+
+def sleep_ms(ms):
+  """Awaitable pause of ms milliseconds."""
+  if hasattr(asyncio, 'sleep_ms'):
+    return asyncio.sleep_ms(ms)
+  return asyncio.sleep(ms / 1000)
+
+
+class Wakeup:
+  """Wake a waiting task from a callback (MIDI, UI) outside the event loop.
+
+  Uses ThreadSafeFlag where there is one, since callbacks can run in the
+  middle of the event loop's own work.
+  """
+
+  def __init__(self):
+    if hasattr(asyncio, 'ThreadSafeFlag'):
+      self.flag = asyncio.ThreadSafeFlag()
+    else:
+      self.flag = asyncio.Event()
+
+  def set(self):
+    self.flag.set()
+
+  async def wait(self):
+    await self.flag.wait()
+    # ThreadSafeFlag clears itself once waited on; an Event doesn't.
+    if hasattr(self.flag, 'clear'):
+      self.flag.clear()
+
+
+class CoalescedControls:
+  """Pass on only the latest value of each control, every period_ms.
+
+  A knob sweep can send far more control changes than a synth needs to
+  recompute for.  control_change() just notes the value, so it's cheap
+  to call from the MIDI callback; task() forwards what changed.
+  """
+  period_ms = 20
+
+  def __init__(self, control_change_fn):
+    self.control_change_fn = control_change_fn
+    self.pending = {}
+
+  def control_change(self, control, value):
+    self.pending[control] = value
+
+  def flush(self):
+    pending = self.pending
+    self.pending = {}
+    for control, value in pending.items():
+      self.control_change_fn(control, value)
+
+  async def task(self):
+    while True:
+      if self.pending:
+        self.flush()
+      await sleep_ms(self.period_ms)
+
+
+class Engine:
+  """A set of tasks to run together on one event loop."""
+
+  def __init__(self):
+    self.coros = []
+    self.tasks = []
+    self.running = False
+
+  def add(self, coro):
+    """Run coro with the others; if already running, start it now."""
+    if self.running:
+      self.tasks.append(asyncio.create_task(coro))
+    else:
+      self.coros.append(coro)
+
+  def every(self, period_ms, fn):
+    """Call fn() every period_ms."""
+    async def periodic():
+      while True:
+        fn()
+        await sleep_ms(period_ms)
+    self.add(periodic())
+
+  async def _main(self):
+    self.running = True
+    self.tasks = [asyncio.create_task(coro) for coro in self.coros]
+    self.coros = []
+    while True:
+      # Stays alive for tasks added later, even if all these finish.
+      await sleep_ms(1000)
+
+  def run(self):
+    asyncio.run(self._main())
@@ -157,12 +157,12 @@ class NoteObj:
   def __init__(self, osc):
     self.osc = osc
 
-  def note_on(self, note, velocity, time=None):
+  def note_on(self, note, velocity, time=None, sequence=None):
     self.note = note
-    amy.send(osc=self.osc, note=note, vel=velocity, time=time)
+    amy.send(osc=self.osc, note=note, vel=velocity, time=time, sequence=sequence)
 
-  def note_off(self, time=None):
-    amy.send(osc=self.osc, vel=0, time=time)
+  def note_off(self, time=None, sequence=None):
+    amy.send(osc=self.osc, vel=0, time=time, sequence=sequence)
 
 
 class JunoPatch:
@@ -514,7 +514,14 @@ def control_change(control, value):
 #arpeggiator.control_change_fwd_fn = control_change
 
 import polyvoice
-polyvoice.init(current_juno(), midi_in, control_change, patch_selector.set_value)
+import engine
+import midiclock
+# MIDI CCs are applied at most every 20 ms, latest value only.
+controls = engine.CoalescedControls(control_change)
+# The arpeggiator keeps time with incoming MIDI clock while it's playing.
+clock = midiclock.MidiClock()
+arpeggiator.follow(clock)
+polyvoice.init(current_juno(), midi_in, controls.control_change, patch_selector.set_value, clock.message)
 
 midi_callback(polyvoice.midi_event_cb)
 
@@ -522,5 +529,12 @@ arpeggiator.synth = polyvoice.SYNTH
 polyvoice.SYNTH = arpeggiator
 #polyvoice.control_change_fn = arpeggiator.control_change
 
-# Arpeggiator run must be launched from main thread, not event thread, since it blocks.
-arpeggiator.run()
+# The arpeggiator and control coalescing share one event loop, which takes
+# over the main thread; MIDI and UI callbacks still run between its tasks.
+# Arpeggiators are stepped by one shared scheduler; more can be added to it.
+arp_scheduler = arpegg.ArpScheduler()
+arp_scheduler.add(arpeggiator)
+tasks = engine.Engine()
+tasks.add(arp_scheduler.task())
+tasks.add(controls.task())
+tasks.run()
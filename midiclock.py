@@ -0,0 +1,134 @@
+"""Follow incoming MIDI clock: tempo and beat phase from jittery pulses.
+
+  clock = MidiClock()
+  clock.message(status)            # from the MIDI callback, for 0xF8-0xFC
+  clock.bpm()                      # None until enough pulses have arrived
+  clock.song_pulse_ms(n)           # AMY ms of pulse n since Start
+"""
+
+import array
+import tulip
+
+CLOCK = 0xF8
+START = 0xFA
+CONTINUE = 0xFB
+STOP = 0xFC
+PULSES_PER_BEAT = 24
+
+# Pulses this far off the fitted line count as a tempo jump...
+JUMP_MS = 25
+# ...once this many arrive in a row; fewer are just jitter.
+JUMP_PULSES = 3
+# A gap this long means the clock stopped; the fit starts over.
+DROPOUT_MS = 500
+
+
+class MidiClock:
+    """Tempo and phase of an external MIDI clock.
+
+    Pulses come 24 to a beat, each stamped with AMY's clock when it reaches
+    us.  USB delivery moves the stamps by several ms, and pulses queued
+    behind other work share a stamp, so following pulses one by one would
+    be worse than a free-running clock.  Instead a least-squares line
+    through the last window pulses gives the ms per pulse (the tempo) and
+    where any pulse falls (the phase); jitter averages out across the window.
+    A run of pulses well off the line is a real tempo change and restarts
+    the fit.
+    """
+
+    def __init__(self, window=48):
+        self.window = window
+        # Stamps of the last window pulses; pulse p is at times[p % window].
+        self.times = array.array('l', [0] * window)
+        # Pulses received, and how many of the latest are in the fit.
+        self.pulse = 0
+        self.count = 0
+        # Pulse number (counting from the first received) of song pulse 0.
+        self.start_pulse = 0
+        self.playing = False
+        self.outliers = 0
+        # The fitted line: pulse p arrives at intercept + slope * p ms.
+        self.slope = None
+        self.intercept = 0
+        # Called with the status byte on Start, Continue and Stop.
+        self.transport_callbacks = []
+
+    def message(self, status, amy_ms=None):
+        """Take a real-time message; False if status isn't one."""
+        if amy_ms is None:
+            amy_ms = tulip.amy_ticks_ms()
+        if status == CLOCK:
+            self._clock(amy_ms)
+        elif status == START:
+            # The next pulse is the first of the song.
+            self.start_pulse = self.pulse
+            self.playing = True
+        elif status == CONTINUE:
+            self.playing = True
+        elif status == STOP:
+            self.playing = False
+        else:
+            return False
+        if status != CLOCK:
+            for callback in self.transport_callbacks:
+                callback(status)
+        return True
+
+    def _clock(self, ms):
+        if self.count:
+            last_ms = self.times[(self.pulse - 1) % self.window]
+            if ms - last_ms > DROPOUT_MS:
+                self.count = 0
+        if self.slope is not None and self.count >= 2:
+            if abs(ms - self.pulse_ms(self.pulse)) > JUMP_MS:
+                self.outliers += 1
+                if self.outliers >= JUMP_PULSES:
+                    # Keep just the pulses since the jump.
+                    self.count = self.outliers - 1
+                    self.outliers = 0
+            else:
+                self.outliers = 0
+        self.times[self.pulse % self.window] = ms
+        self.pulse += 1
+        self.count = min(self.count + 1, self.window)
+        self._fit()
+
+    def _fit(self):
+        n = self.count
+        if n < 2:
+            return
+        first = self.pulse - n
+        # Fit relative to the first pulse and stamp, keeping the sums small.
+        t0 = self.times[first % self.window]
+        sum_x = sum_y = sum_xx = sum_xy = 0
+        for i in range(n):
+            y = self.times[(first + i) % self.window] - t0
+            sum_x += i
+            sum_y += y
+            sum_xx += i * i
+            sum_xy += i * y
+        slope = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x * sum_x)
+        if slope <= 0:
+            # All stamped together, so far; no tempo yet.
+            return
+        self.slope = slope
+        self.intercept = t0 + (sum_y - slope * sum_x) / n - slope * first
+
+    def pulse_ms(self, pulse):
+        """When pulse number pulse (counted from the first received) arrives, in AMY ms."""
+        return self.intercept + self.slope * pulse
+
+    def song_pulse(self):
+        """The song pulse the next clock will be."""
+        return self.pulse - self.start_pulse
+
+    def song_pulse_ms(self, song_pulse):
+        return self.pulse_ms(self.start_pulse + song_pulse)
+
+    def ms_per_pulse(self):
+        return self.slope
+
+    def bpm(self):
+        if self.slope is None:
+            return None
+        return 60000 / (self.slope * PULSES_PER_BEAT)
@@ -0,0 +1,200 @@
+"""Streaming Standard MIDI File (type 0 and 1) reader and writer.
+
+Events are read straight from the file a buffer at a time, and written
+through a small buffer, so neither side holds a whole file's events.
+"""
+
+import struct
+
+# Status value used for tempo changes in the event stream (data1 = 0x51).
+META = 0xFF
+META_TEMPO = 0x51
+_META_END_OF_TRACK = 0x2F
+# Default tempo if a file never sets one, in microseconds per quarter note.
+DEFAULT_TEMPO = 500000
+
+
+class _ChunkStream:
+    """Bytes of one chunk, read from the file a buffer at a time."""
+
+    def __init__(self, f, length, buffer_size=512):
+        self.f = f
+        self.remaining = length
+        self.buffer_size = buffer_size
+        self.buffer = b''
+        self.pos = 0
+
+    def more(self):
+        return self.pos < len(self.buffer) or self.remaining > 0
+
+    def byte(self):
+        if self.pos == len(self.buffer):
+            if self.remaining <= 0:
+                raise ValueError('MIDI track chunk ends mid-event')
+            self.buffer = self.f.read(min(self.buffer_size, self.remaining))
+            self.remaining -= len(self.buffer)
+            self.pos = 0
+        value = self.buffer[self.pos]
+        self.pos += 1
+        return value
+
+    def varlen(self):
+        value = 0
+        while True:
+            byte = self.byte()
+            value = (value << 7) | (byte & 0x7f)
+            if byte < 0x80:
+                return value
+
+    def skip(self, length):
+        for _ in range(length):
+            self.byte()
+
+    def skip_rest(self):
+        """Move the file past whatever is left of the chunk."""
+        if self.remaining > 0:
+            self.f.seek(self.remaining, 1)
+            self.remaining = 0
+        self.pos = len(self.buffer)
+
+
+class MidiFileReader:
+    """Read the header of an SMF, then stream its tracks' events.
+
+    for track in reader.tracks():
+        for tick, status, data1, data2 in track:
+            ...
+
+    Channel messages come with their full status byte (running status is
+    expanded).  Tempo changes come as (tick, META, META_TEMPO, tempo); other
+    meta and sysex events are skipped.  Tracks must be consumed in order.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        chunk_type, length = struct.unpack('>4sL', f.read(8))
+        if chunk_type != b'MThd':
+            raise ValueError('not a standard MIDI file')
+        self.format, self.num_tracks, self.division = struct.unpack('>HHH', f.read(6))
+        if self.division & 0x8000:
+            raise ValueError('SMPTE time division not supported')
+        f.seek(length - 6, 1)
+
+    def tracks(self):
+        for _ in range(self.num_tracks):
+            header = self.f.read(8)
+            if len(header) < 8:
+                return
+            chunk_type, length = struct.unpack('>4sL', header)
+            stream = _ChunkStream(self.f, length)
+            if chunk_type == b'MTrk':
+                yield self._events(stream)
+            stream.skip_rest()
+
+    @staticmethod
+    def _events(stream):
+        tick = 0
+        status = 0
+        while stream.more():
+            tick += stream.varlen()
+            byte = stream.byte()
+            if byte == 0xFF:
+                meta_type = stream.byte()
+                length = stream.varlen()
+                if meta_type == META_TEMPO and length == 3:
+                    tempo = (stream.byte() << 16) | (stream.byte() << 8) | stream.byte()
+                    yield tick, META, META_TEMPO, tempo
+                else:
+                    stream.skip(length)
+                if meta_type == _META_END_OF_TRACK:
+                    return
+                continue
+            if byte == 0xF0 or byte == 0xF7:
+                stream.skip(stream.varlen())
+                continue
+            if byte & 0x80:
+                status = byte
+                data1 = stream.byte()
+            else:
+                # Running status: this byte is the first data byte.
+                data1 = byte
+            kind = status & 0xF0
+            if kind == 0xC0 or kind == 0xD0:
+                data2 = 0
+            else:
+                data2 = stream.byte()
+            yield tick, status, data1, data2
+
+
+class MidiFileWriter:
+    """Write an SMF track by track, with running status.
+
+    writer = MidiFileWriter(f, num_tracks, division)
+    writer.begin_track()
+    writer.event(tick, status, data1, data2)  # ticks non-decreasing
+    writer.end_track()
+    """
+
+    def __init__(self, f, num_tracks, division=480, format=1):
+        self.f = f
+        self.division = division
+        f.write(struct.pack('>4sLHHH', b'MThd', 6, format, num_tracks, division))
+        self.buffer = bytearray()
+
+    def _varlen(self, value):
+        # Most significant group first, continuation bit on all but the last.
+        groups = [value & 0x7f]
+        value >>= 7
+        while value:
+            groups.append((value & 0x7f) | 0x80)
+            value >>= 7
+        self.buffer.extend(bytes(reversed(groups)))
+
+    def _flush(self):
+        self.f.write(self.buffer)
+        self.length += len(self.buffer)
+        self.buffer = bytearray()
+
+    def begin_track(self):
+        self.chunk_start = self.f.tell()
+        # Length is patched in by end_track().
+        self.f.write(struct.pack('>4sL', b'MTrk', 0))
+        self.length = 0
+        self.tick = 0
+        self.status = 0
+
+    def _delta(self, tick):
+        tick = max(tick, self.tick)
+        self._varlen(tick - self.tick)
+        self.tick = tick
+
+    def event(self, tick, status, data1, data2=None):
+        self._delta(tick)
+        if status != self.status:
+            self.buffer.append(status)
+            self.status = status
+        self.buffer.append(data1 & 0x7f)
+        if data2 is not None:
+            self.buffer.append(data2 & 0x7f)
+        if len(self.buffer) >= 512:
+            self._flush()
+
+    def meta(self, tick, meta_type, data):
+        self._delta(tick)
+        self.buffer.append(0xFF)
+        self.buffer.append(meta_type)
+        self._varlen(len(data))
+        self.buffer.extend(data)
+        # Meta events cancel running status.
+        self.status = 0
+
+    def tempo(self, tick, tempo):
+        self.meta(tick, META_TEMPO, bytes([(tempo >> 16) & 0xFF, (tempo >> 8) & 0xFF, tempo & 0xFF]))
+
+    def end_track(self):
+        self.meta(self.tick, _META_END_OF_TRACK, b'')
+        self._flush()
+        end = self.f.tell()
+        self.f.seek(self.chunk_start + 4)
+        self.f.write(struct.pack('>L', self.length))
+        self.f.seek(end)
@@ -90,14 +90,14 @@ class Synth:
   """Manage a polyphonic synthesizer by rotating among a fixed pool of voices.
 
   Provides methods:
-    synth.note_on(midi_note, velocity)
-    synth.note_off(midi_note)
+    synth.note_on(midi_note, velocity, time=None)
+    synth.note_off(midi_note, time=None)
     synth.control_change(control, value)
     synth.set_patch(patch_num)
   
   Argument voice_source provides the following methods:
     voice_source.get_new_voices(num_voices) returns num_voices VoiceObjects.
-      VoiceObjects accept voice.note_on(note, vel), voice.note_off()
+      VoiceObjects accept voice.note_on(note, vel, time=None), voice.note_off(time=None)
     voice_source.set_patch(patch_num) changes preset for all voices.
     voice_source.control_change(control, value) modifies a parameter for all voices.
   """
@@ -113,7 +113,7 @@ class Synth:
     self.voice_of_note = {}
     self.note_of_voice = [None] * num_voices
 
-  def get_next_voice(self):
+  def get_next_voice(self, time=None):
     """Return the next voice to use."""
     # First try free/released_voices in order, then steal from active_voices.
     if not self.released_voices.empty():
@@ -121,39 +121,44 @@ class Synth:
     # We have to steal an active voice.
     stolen_voice = self.active_voices.get()
     print('Stealing voice for', self.note_of_voice[stolen_voice])
-    self.voice_off(stolen_voice)
+    self.voice_off(stolen_voice, time)
     return stolen_voice
 
-  def voice_off(self, voice):
+  def voice_off(self, voice, time=None):
     """Terminate voice, update note_of_voice, but don't alter the queues."""
-    self.voices[voice].note_off()
+    self.voices[voice].note_off(time=time)
     # We no longer have a voice playing this note.
     del self.voice_of_note[self.note_of_voice[voice]]
     self.note_of_voice[voice] = None
 
-  def note_off(self, note):
+  def note_off(self, note, time=None):
+    """Release note, at AMY time (ms) if given, else now."""
     if note not in self.voice_of_note:
       return
     old_voice = self.voice_of_note[note]
-    self.voice_off(old_voice)
+    self.voice_off(old_voice, time)
     # Return to released.
     self.active_voices.remove(old_voice)
     self.released_voices.put(old_voice)
 
-  def note_on(self, note, velocity):
+  def note_on(self, note, velocity, time=None):
     if velocity == 0:
-      self.note_off(note)
+      self.note_off(note, time)
     else:
       # Velocity > 0, note on.
       if note in self.voice_of_note:
         # Send another note-on to the voice already playing this note.
         new_voice = self.voice_of_note[note]
       else:
-        new_voice = self.get_next_voice()
+        new_voice = self.get_next_voice(time)
         self.active_voices.put(new_voice)
         self.voice_of_note[note] = new_voice
         self.note_of_voice[new_voice] = note
-      self.voices[new_voice].note_on(note, velocity)
+      self.voices[new_voice].note_on(note, velocity, time=time)
+
+  def get_new_voices(self, num_voices):
+    """Voices outside the pool, e.g. for an arpeggiator to drive directly."""
+    return self.voice_source.get_new_voices(num_voices)
 
   def set_patch(self, patch_number):
     self.voice_source.set_patch(patch_number)
@@ -164,6 +169,7 @@ class Synth:
 midi_in_fn = None
 control_change_fn = None
 set_patch_fn = None
+clock_fn = None
 SYNTH = None
 
 def midi_event_cb(x):
@@ -171,6 +177,13 @@ def midi_event_cb(x):
   m = midi_in_fn()  # tulip.midi_in()
   while m is not None and len(m) > 0:
     #print("midi in: 0x%x 0x%x 0x%x" % (m[0], m[1], m[2]))
+    if m[0] >= 0xf8:  # Real-time (clock, start, stop) messages are one byte.
+      if clock_fn:
+        clock_fn(m[0])
+      m = m[1:]
+      if len(m) == 0:
+        m = midi_in_fn()
+      continue
     if m[0] == 0x90:  # Note on.
       midinote = m[1]
       midivel = m[2]
@@ -199,14 +212,16 @@ def midi_event_cb(x):
 
 
 
-def init(synth=None, my_midi_in_fn=None, my_control_change_fn=None, my_set_patch_fn=None):
+def init(synth=None, my_midi_in_fn=None, my_control_change_fn=None, my_set_patch_fn=None, my_clock_fn=None):
   # Install the callback.
   #tulip.midi_callback(midi_event_cb)
-  global midi_in_fn, control_change_fn, set_patch_fn, SYNTH
+  global midi_in_fn, control_change_fn, set_patch_fn, clock_fn, SYNTH
 
   midi_in_fn = my_midi_in_fn
   control_change_fn = my_control_change_fn
   set_patch_fn = my_set_patch_fn
+  # Gets MIDI clock, start, continue and stop status bytes.
+  clock_fn = my_clock_fn
 
   #if not synth:
   #    import juno
@@ -0,0 +1,139 @@
+"""Render scripted pieces faster than real time, away from a live AMY.
+
+For checking pieces on a desktop machine with AMY's Python module.
+Recording runs a piece against a stand-in for AMY on a virtual clock:
+amy.millis() reads the virtual clock, time.sleep() and time.sleep_ms()
+advance it instantly, and everything sent to AMY goes to a log instead.
+The log can then be printed as a time-ordered message trace, e.g. to diff
+against a known-good one.
+
+  python3 render.py record xanadu:xanadu xanadu.log
+  python3 render.py trace xanadu.log > xanadu.trace
+
+A piece is module:function.  If the function returns a score (see
+score.py) it is played with a ScorePlayer; otherwise it is expected to
+play itself, sleeping as it goes.  Pieces that need Tulip's display or
+MIDI (dpweseq, the arpeggiator) can't run here.
+
+The log has a line per send, "send_ms message", where message is AMY's
+wire format: one or more messages, each ending in 'Z'.
+"""
+
+import re
+import sys
+import time
+import amy
+
+# Stamp times in wire messages; messages without one happen when sent.
+_TIME = re.compile(r't(-?\d+)')
+
+
+class OfflineAmy:
+    """Stand in for live AMY while a piece runs: log what it sends, on a virtual clock.
+
+      with OfflineAmy('piece.log') as offline:
+          ...  # amy.send() etc. are logged; offline.now_ms is the clock.
+
+    The amy and time modules are patched in place, so modules that have
+    already imported them are recorded too.
+    """
+
+    def __init__(self, filename, start_ms=0):
+        self.filename = filename
+        self.now_ms = start_ms
+        self.sends = 0
+        self.saved = {}
+
+    def millis(self):
+        return self.now_ms
+
+    def sleep_ms(self, ms):
+        self.now_ms += max(0, int(ms))
+
+    def sleep(self, seconds):
+        self.sleep_ms(round(seconds * 1000))
+
+    def send_raw(self, message):
+        self.log.write('%d %s\n' % (self.now_ms, message))
+        self.sends += 1
+
+    def send(self, **kwargs):
+        self.send_raw(amy.message(**kwargs))
+
+    def _patch(self, module, name, value):
+        self.saved[(module, name)] = getattr(module, name, None)
+        setattr(module, name, value)
+
+    def __enter__(self):
+        self.log = open(self.filename, 'w')
+        self._patch(amy, 'send', self.send)
+        self._patch(amy, 'send_raw', self.send_raw)
+        self._patch(amy, 'millis', self.millis)
+        self._patch(amy, 'live', lambda *args, **kwargs: None)
+        self._patch(time, 'sleep', self.sleep)
+        self._patch(time, 'sleep_ms', self.sleep_ms)
+        return self
+
+    def __exit__(self, *exc):
+        for (module, name), value in self.saved.items():
+            if value is None:
+                delattr(module, name)
+            else:
+                setattr(module, name, value)
+        self.saved = {}
+        self.log.close()
+        return False
+
+
+def _piece(spec):
+    module_name, _, function_name = spec.partition(':')
+    module = __import__(module_name)
+    return getattr(module, function_name or 'play')
+
+
+def record(spec, filename, start_delay_ms=100):
+    """Run the piece spec ("module:function") offline, logging it to filename."""
+    with OfflineAmy(filename) as offline:
+        # Imported here, as some pieces start AMY on import.
+        events = _piece(spec)()
+        if events is not None:
+            import score
+            score.ScorePlayer(events, start_ms=offline.now_ms + start_delay_ms).run()
+    return offline
+
+
+def read_log(filename):
+    """Yield (amy_ms, message) for each message in a log, in the order sent."""
+    with open(filename, 'r') as f:
+        for line in f:
+            send_ms, _, messages = line.rstrip('\n').partition(' ')
+            send_ms = int(send_ms)
+            for message in messages.split('Z'):
+                if message:
+                    stamp = _TIME.search(message)
+                    yield (int(stamp.group(1)) if stamp else send_ms), message + 'Z'
+
+
+def trace(filename, out=sys.stdout):
+    """Write a log's messages in the order AMY will play them, each with its time."""
+    # Stable, so messages for the same time keep the order they were sent in.
+    for amy_ms, message in sorted(read_log(filename), key=lambda event: event[0]):
+        out.write('%d %s\n' % (amy_ms, message))
+
+
+def main(args):
+    if len(args) == 3 and args[0] == 'record':
+        started = time.time()
+        offline = record(args[1], args[2])
+        print('%s: %d sends, %.1f s of music in %.2f s'
+              % (args[2], offline.sends, offline.now_ms / 1000, time.time() - started))
+    elif len(args) == 2 and args[0] == 'trace':
+        trace(args[1])
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
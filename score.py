@@ -0,0 +1,351 @@
+"""Scores of timed notes for AMY voices, and a player that streams them.
+
+A score is any iterable of events
+
+    (time, voice, pitch, args)
+
+time in seconds from the start, voice a name in VOICES, pitch in the
+csound OCT.STEP form (4.09 is the A above middle C), and args a dict of
+keyword arguments for the voice.  Events must come in time order:
+ScorePlayer only reads as far ahead as it needs, so a score written as a
+generator (or read from a file with read_score) streams in bounded memory,
+and an event yielded after a later one would go out late.
+Give the player a new iterator to play a score again.
+"""
+
+import math
+import time
+import heapq
+import amy
+import engine
+
+TOTAL_OSCS = 64
+NUM_USABLE_OSCS = 62
+OSC_BLOCKING = 32  # Don't let sets of oscs straddle this.
+
+C0_FREQ = 440.0 / math.pow(2.0, 4 + 9/12)
+
+
+class OscLeases:
+    """Hand out blocks of oscs for as long as each note actually sounds.
+
+    Each osc is leased until a known end time, so a block is only reused
+    once its last note has finished, tail included.  If every block is
+    still busy, the one that frees soonest is taken.
+
+    Note-offs wait here rather than in AMY's queue, and go out only once
+    every allocation up to their time has been made: one can never land
+    on an osc that has been re-leased since, even if a lease is stolen.
+    Allocation must therefore come in timestamp order, as ScorePlayer
+    releases events; lease() raises ValueError if it doesn't.
+    """
+
+    def __init__(self, num_oscs=NUM_USABLE_OSCS, blocking=OSC_BLOCKING):
+        self.blocking = blocking
+        # When each osc's lease ends, in AMY ms, and which lease it is.
+        self.free_ms = [0] * num_oscs
+        self.lease_of = [0] * num_oscs
+        self.leases = 0
+        # Start of the latest lease; allocation can't go back before it.
+        self.last_start_ms = None
+        # Heap of (time, lease, osc) note-offs not yet sent.
+        self.note_offs = []
+
+    def lease(self, num_oscs, start_ms, end_ms, reset=True):
+        """num_oscs consecutive oscs, within one blocking, from start_ms to end_ms.
+
+        Unless reset is False (the caller resets them itself), each is reset at start_ms.
+        Leases must be taken in start_ms order.
+        """
+        if self.last_start_ms is not None and start_ms < self.last_start_ms:
+            # Note-offs up to last_start_ms may already be sent, and blocks
+            # freed, that a note starting earlier would collide with.
+            raise ValueError('osc lease at %d ms is before one at %d ms' % (start_ms, self.last_start_ms))
+        self.last_start_ms = start_ms
+        self.flush(start_ms)
+        free_ms = self.free_ms
+        best = None
+        best_free_ms = None
+        for first in range(len(free_ms) - num_oscs + 1):
+            if first // self.blocking != (first + num_oscs - 1) // self.blocking:
+                continue
+            frees_ms = max(free_ms[first:first + num_oscs])
+            if frees_ms <= start_ms:
+                best = first
+                break
+            if best_free_ms is None or frees_ms < best_free_ms:
+                best, best_free_ms = first, frees_ms
+        self.leases += 1
+        oscs = list(range(best, best + num_oscs))
+        for osc in oscs:
+            free_ms[osc] = end_ms
+            self.lease_of[osc] = self.leases
+            if reset:
+                # Clear the last note's setup, but not before this one starts.
+                amy.send(reset=osc, timestamp=start_ms)
+        return oscs
+
+    def note_off(self, osc, time_ms):
+        """Release osc at time_ms, unless it has been re-leased by then."""
+        heapq.heappush(self.note_offs, (time_ms, self.lease_of[osc], osc))
+
+    def flush(self, until_ms):
+        """Send the note-offs before until_ms."""
+        note_offs = self.note_offs
+        messages = []
+        while note_offs and note_offs[0][0] < until_ms:
+            time_ms, lease, osc = heapq.heappop(note_offs)
+            if self.lease_of[osc] == lease:
+                messages.append(amy.message(osc=osc, vel=0, timestamp=time_ms))
+        if messages:
+            amy.send_raw(''.join(messages))
+
+    def next_note_off_ms(self):
+        return self.note_offs[0][0] if self.note_offs else None
+
+
+LEASES = OscLeases()
+
+
+def get_oscs(num_oscs, timestamp=None, end_ms=None, reset=True):
+    """Lease num_oscs oscs from timestamp (default now) until end_ms (default 10 s on)."""
+    if timestamp is None:
+        timestamp = amy.millis()
+    if end_ms is None:
+        end_ms = timestamp + 10000
+    return LEASES.lease(num_oscs, timestamp, end_ms, reset)
+
+
+# A piece uses few distinct pitches, over and over, so conversions are
+# remembered.  The tables are emptied if they ever grow past this.
+MAX_MEMO = 256
+_FREQS = {}
+_SHIFTS = {}
+
+
+def pitch2freq(pitch):
+    # Pitch in OCT.(STEP/100)
+    freq = _FREQS.get(pitch)
+    if freq is None:
+        oct = math.floor(pitch)
+        step = 100 * (pitch - oct)
+        freq = C0_FREQ * math.pow(2.0, oct + step/12)
+        if len(_FREQS) >= MAX_MEMO:
+            _FREQS.clear()
+        _FREQS[pitch] = freq
+    return freq
+
+
+def shift_pitch(pitch, shift):
+    shifted = _SHIFTS.get((pitch, shift))
+    if shifted is None:
+        oct = math.floor(pitch)
+        step = 100 * (pitch - oct)
+        s_oct = math.floor(shift)
+        s_step = 100 * (shift - s_oct)
+        final_step = step + s_step
+        final_oct = oct + s_oct + (final_step // 12)
+        final_step = final_step % 12
+        shifted = final_oct + (final_step / 100)
+        if len(_SHIFTS) >= MAX_MEMO:
+            _SHIFTS.clear()
+        _SHIFTS[(pitch, shift)] = shifted
+    return shifted
+
+
+# Message templates.  A voice sets up its oscs the same way for every note
+# on the same block, so the wire messages for that (resets included) are
+# built once, with a placeholder for the timestamp.  Each note is then one
+# amy.send_raw of the filled-in template plus its own note-on.
+
+_STAMP = 987654321
+_TEMPLATES = {}
+
+
+def _template(key, messages):
+    """The setup messages (a list of amy.send kwargs) for key, as one format string."""
+    template = _TEMPLATES.get(key)
+    if template is None:
+        wire = ''.join(amy.message(timestamp=_STAMP, **kwargs) for kwargs in messages())
+        template = wire.replace(str(_STAMP), '%(t)d')
+        if len(_TEMPLATES) >= MAX_MEMO:
+            _TEMPLATES.clear()
+        _TEMPLATES[key] = template
+    return template
+
+
+# Voices.  Each leases oscs for as long as it sounds and plays pitch at
+# AMY time timestamp (ms), with its note-off at the end of duration seconds.
+
+# The saw voices' amp envelope dies away by itself after this long...
+SAW_DECAY_MS = 8100
+# ...and this long after a note-off.
+SAW_RELEASE_MS = 250
+FM_RELEASE_MS = 200
+
+
+def _saw_setup(osc, modosc, modwave, modfreq, modamp):
+    return [
+        {'reset': osc},
+        {'reset': modosc},
+        {'osc': modosc, 'wave': modwave, 'freq': modfreq, 'amp': modamp},
+        {'osc': osc, 'wave': amy.SAW_DOWN, 'freq': 440, 'mod_source': modosc, 'mod_target': amy.TARGET_FREQ,
+         'filter_freq': 500, 'filter_type': amy.FILTER_LPF,
+         'bp0': "5000,0.01,0,0", 'bp0_target': amy.TARGET_FILTER_FREQ, 'resonance': 0.5,
+         'bp1': "100,1.0,8000,0.0,250,0", 'bp1_target': amy.TARGET_AMP},
+    ]
+
+
+def note1(pitch, timestamp, vel=1.0, duration=10.0, pan=0.5):
+    """Filtered saw with slight vibrato."""
+    off_ms = timestamp + min(int(duration * 1000), SAW_DECAY_MS)
+    osc, modosc = get_oscs(2, timestamp, off_ms + SAW_RELEASE_MS, reset=False)
+    setup = _template(('note1', osc),
+                      lambda: _saw_setup(osc, modosc, amy.SINE, 5, 0.005))
+    amy.send_raw(setup % {'t': timestamp}
+                 + amy.message(osc=osc, freq=pitch2freq(pitch), vel=vel, timestamp=timestamp, pan=pan))
+    LEASES.note_off(osc, off_ms)
+
+
+def note2(pitch, timestamp, vel=1.0, pitch_dev=0.05, duration=10.0, pan=0.5):
+    """Filtered saw with a slow downward pitch sweep of pitch_dev."""
+    off_ms = timestamp + min(int(duration * 1000), SAW_DECAY_MS)
+    osc, modosc = get_oscs(2, timestamp, off_ms + SAW_RELEASE_MS, reset=False)
+    setup = _template(('note2', osc, pitch_dev),
+                      lambda: _saw_setup(osc, modosc, amy.SAW_DOWN, 0.1, pitch_dev))
+    amy.send_raw(setup % {'t': timestamp}
+                 + amy.message(osc=osc, freq=pitch2freq(pitch), vel=vel, timestamp=timestamp, pan=pan))
+    LEASES.note_off(osc, off_ms)
+
+
+def _fm_setup(oscs, duration):
+    return [{'reset': osc} for osc in oscs] + [
+        {'osc': oscs[2], 'wave': amy.SINE, 'freq': 1/duration, 'phase': 0.75, 'amp': 1},
+        {'osc': oscs[1], 'wave': amy.SINE, 'ratio': 1, 'amp': 0.1, 'mod_source': oscs[2],
+         'mod_target': amy.TARGET_AMP},
+        {'osc': oscs[0], 'wave': amy.SINE, 'ratio': 1, 'amp': 0.2, 'bp0_target': amy.TARGET_AMP,
+         'bp0': "0,0,1000,1,1000,0"},
+        {'osc': oscs[3], 'wave': amy.ALGO, 'algorithm': 1, 'algo_source': "-1,-1,-1,-1,%d,%d" % (oscs[1], oscs[0]),
+         'bp0_target': amy.TARGET_AMP, 'bp0': "0,1,1000,1,200,0"},
+        {'osc': oscs[1], 'vel': 0.3},
+    ]
+
+
+def note_fm(pitch, timestamp, vel=1.0, duration=8.0):
+    """Two-operator FM, its modulation swelling and fading over duration."""
+    off_ms = timestamp + int(duration * 1000)
+    oscs = get_oscs(4, timestamp, off_ms + FM_RELEASE_MS, reset=False)
+    setup = _template(('fm', oscs[0], duration), lambda: _fm_setup(oscs, duration))
+    amy.send_raw(setup % {'t': timestamp}
+                 + amy.message(osc=oscs[3], freq=pitch2freq(pitch), vel=vel, timestamp=timestamp))
+    LEASES.note_off(oscs[3], off_ms)
+
+
+def volume(pitch, timestamp, level=1.0):
+    """Set the overall volume (pitch is ignored), e.g. for fades."""
+    amy.send(volume=level, timestamp=timestamp)
+
+
+VOICES = {'note1': note1, 'note2': note2, 'fm': note_fm, 'volume': volume}
+
+
+def read_score(filename):
+    """Stream a score file: one event per line, "time voice pitch key=value ...".
+
+    Blank lines and lines starting with # are skipped.
+    """
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            args = {}
+            for field in fields[3:]:
+                key, value = field.split('=')
+                args[key] = float(value)
+            yield float(fields[0]), fields[1], float(fields[2]), args
+
+
+def write_score(filename, events):
+    with open(filename, 'w') as f:
+        for event_time, voice, pitch, args in events:
+            f.write('%g %s %g' % (event_time, voice, pitch))
+            for key, value in args.items():
+                f.write(' %s=%g' % (key, value))
+            f.write('\n')
+
+
+class ScorePlayer:
+    """Send a score's events to AMY, timestamped, a few seconds ahead of time.
+
+    Nothing waits for a note to be due: service() releases everything up to
+    lookahead_ms ahead, and says how long until more is needed.  Only events
+    inside that window are held.
+    """
+
+    def __init__(self, events, start_ms=None, lookahead_ms=2000):
+        self.events = iter(events)
+        self.lookahead_ms = lookahead_ms
+        self.start_ms = amy.millis() if start_ms is None else start_ms
+        # (timestamp, count, voice, pitch, args) read from the score but not yet sent.
+        self.pending = []
+        self.count = 0
+        # Timestamp of the last event read; reading stops once it's past the window.
+        self.read_ms = None
+        self.last_ms = self.start_ms
+        self.exhausted = False
+
+    def _read_until(self, end_ms):
+        while not self.exhausted and (self.read_ms is None or self.read_ms < end_ms):
+            try:
+                event_time, voice, pitch, args = next(self.events)
+            except StopIteration:
+                self.exhausted = True
+                return
+            timestamp = int(round(self.start_ms + event_time * 1000))
+            if self.read_ms is not None and timestamp < self.read_ms:
+                raise ValueError('score event at %g s is out of time order' % event_time)
+            self.read_ms = timestamp
+            self.count += 1
+            heapq.heappush(self.pending, (timestamp, self.count, voice, pitch, args))
+
+    def service(self, now_ms):
+        """Release the events (and note-offs) due before now_ms + lookahead_ms;
+        return ms until the next needs releasing, or None once all are sent."""
+        end_ms = now_ms + self.lookahead_ms
+        self._read_until(end_ms)
+        pending = self.pending
+        while pending and pending[0][0] < end_ms:
+            timestamp, _, voice, pitch, args = heapq.heappop(pending)
+            VOICES[voice](pitch, timestamp, **args)
+            self.last_ms = max(self.last_ms, timestamp)
+        # Everything before end_ms is allocated, so its note-offs are safe to send.
+        LEASES.flush(end_ms)
+        next_ms = LEASES.next_note_off_ms()
+        if next_ms is not None:
+            self.last_ms = max(self.last_ms, next_ms)
+        if pending:
+            next_ms = pending[0][0] if next_ms is None else min(next_ms, pending[0][0])
+        elif not self.exhausted:
+            next_ms = self.read_ms if next_ms is None else min(next_ms, self.read_ms)
+        if next_ms is None:
+            return None
+        return max(1, next_ms - end_ms)
+
+    def run(self):
+        """Play the score, returning once its last event has sounded."""
+        while True:
+            wait_ms = self.service(amy.millis())
+            if wait_ms is None:
+                break
+            time.sleep_ms(wait_ms)
+        time.sleep_ms(max(0, self.last_ms - amy.millis()))
+
+    async def task(self):
+        """run() as a cooperative task on an engine.Engine's event loop."""
+        while True:
+            wait_ms = self.service(amy.millis())
+            if wait_ms is None:
+                break
+            await engine.sleep_ms(wait_ms)
+        await engine.sleep_ms(max(0, self.last_ms - amy.millis()))
@@ -0,0 +1,384 @@
+"""File formats for dpweseq: the recording journal and the saved sequence."""
+
+import os
+import struct
+
+# The recording journal is an append-only file of fixed-size records, written
+# as MIDI events are recorded so a crash loses at most the unflushed tail.
+# Each record packs (track, status, data1, data2, tick); status is a MIDI
+# status byte, or one of the TAKE_* markers below.
+
+# Version 1 journals have times in ms rather than ticks.
+JOURNAL_MAGIC = b'DSJ'
+JOURNAL_VERSION = 2
+_JOURNAL_HEADER = JOURNAL_MAGIC + bytes([JOURNAL_VERSION])
+_RECORD = '<BBBBl'
+RECORD_SIZE = struct.calcsize(_RECORD)
+
+# Non-MIDI status values marking the start (tick = clear-from point) and
+# end (tick = time live notes were stopped) of a recording take.
+TAKE_START = 0x01
+TAKE_END = 0x02
+
+
+class JournalWriter:
+    """Buffer journal records in memory, append them to the file on flush()."""
+
+    def __init__(self, filename, buffer_records=256):
+        self.filename = filename
+        self.buffer = bytearray(RECORD_SIZE * buffer_records)
+        self.used = 0
+        # Set False to drop records, e.g. while replaying the journal itself.
+        self.enabled = True
+
+    def reset(self):
+        """Truncate the journal, discarding any buffered records."""
+        self.used = 0
+        with open(self.filename, 'wb') as f:
+            f.write(_JOURNAL_HEADER)
+
+    def append(self, track, status, data1, data2, tick):
+        if not self.enabled:
+            return
+        if self.used == len(self.buffer):
+            self.flush()
+        struct.pack_into(_RECORD, self.buffer, self.used, track, status, data1, data2, int(tick))
+        self.used += RECORD_SIZE
+
+    def flush(self):
+        if self.used:
+            with open(self.filename, 'ab') as f:
+                if f.seek(0, 2) == 0:
+                    # Starting a new journal file.
+                    f.write(_JOURNAL_HEADER)
+                f.write(memoryview(self.buffer)[:self.used])
+            self.used = 0
+
+
+def journal_version(filename):
+    """Return the journal's format version, or None if there's no readable journal."""
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(len(_JOURNAL_HEADER))
+    except OSError:
+        return None
+    if len(header) < len(_JOURNAL_HEADER) or header[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+        return None
+    return header[-1]
+
+
+def repair_journal(filename, chunk_size=4096):
+    """Cut a torn final record (e.g. power lost mid-write) off the journal.
+
+    Appends go on the end of the file, so one partial record would leave
+    every later record misaligned.  Returns True if the journal was cut.
+    """
+    recover_file(filename)
+    try:
+        size = os.stat(filename)[6]
+    except OSError:
+        return False
+    if size < len(_JOURNAL_HEADER):
+        # Not even a whole header; flush() starts the file again.
+        os.remove(filename)
+        return size > 0
+    keep = size - (size - len(_JOURNAL_HEADER)) % RECORD_SIZE
+    if keep == size:
+        return False
+    # MicroPython files can't be truncated, so copy the whole records.
+    with open(filename, 'rb') as src, open(filename + '.tmp', 'wb') as dst:
+        while keep > 0:
+            chunk = src.read(min(chunk_size, keep))
+            dst.write(chunk)
+            keep -= len(chunk)
+    replace_file(filename + '.tmp', filename)
+    return True
+
+
+def read_journal(filename, chunk_records=64):
+    """Yield (track, status, data1, data2, tick) for each complete record in the journal."""
+    if not 1 <= (journal_version(filename) or 0) <= JOURNAL_VERSION:
+        return
+    with open(filename, 'rb') as f:
+        f.seek(len(_JOURNAL_HEADER))
+        while True:
+            chunk = f.read(RECORD_SIZE * chunk_records)
+            if not chunk:
+                return
+            # A torn final record (e.g. power lost mid-write) is ignored.
+            for offset in range(0, len(chunk) - RECORD_SIZE + 1, RECORD_SIZE):
+                yield struct.unpack_from(_RECORD, chunk, offset)
+
+
+# The saved sequence.  A fixed header, the tempo map, the offset of the
+# automation section and the per-track table are followed by each track's
+# block table, then the blocks themselves.  A block holds up to
+# block_size consecutive notes as columns: varint on-tick deltas (from the
+# block's first tick), varint durations + 1 (0 for a note with no end),
+# varint channels, then one byte each of note and velocity.  The block
+# tables give each block's tick range, so a reader can pick out the blocks
+# it wants first and seek straight to them.  The automation section, at the
+# end, has for each track a lane count, then for each lane a header and its
+# points as varint tick deltas followed by zigzag varint values.
+
+# Version 1 had no tempo map, and times in ms rather than ticks.
+# Version 2 had no automation.
+SEQ_MAGIC = b'DSEQ'
+SEQ_VERSION = 3
+_SEQ_HEADER = '<4sBBH'  # magic, version, num_tracks, block_size
+_TEMPO_HEADER = '<H'  # num_tempo_segments (version 2 on)
+_TEMPO_ENTRY = '<lf'  # start tick, bpm
+_AUTOMATION_OFFSET = '<L'  # offset of the automation section (version 3 on)
+_LANE_COUNT = '<H'  # num_lanes, for each track
+_LANE_HEADER = '<BBL'  # kind (status nibble), controller, num_points
+_TRACK_ENTRY = '<LHL'  # num_notes, num_blocks, block table offset
+_BLOCK_ENTRY = '<llLLH'  # first on tick, last off tick, data offset, data length, num_notes
+# What struct raises on short data: struct.error in CPython, ValueError in MicroPython.
+_STRUCT_ERROR = getattr(struct, 'error', ValueError)
+
+SEQ_HEADER_SIZE = struct.calcsize(_SEQ_HEADER)
+TEMPO_HEADER_SIZE = struct.calcsize(_TEMPO_HEADER)
+TEMPO_ENTRY_SIZE = struct.calcsize(_TEMPO_ENTRY)
+AUTOMATION_OFFSET_SIZE = struct.calcsize(_AUTOMATION_OFFSET)
+TRACK_ENTRY_SIZE = struct.calcsize(_TRACK_ENTRY)
+BLOCK_ENTRY_SIZE = struct.calcsize(_BLOCK_ENTRY)
+
+
+def _put_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _get_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _encode_lanes(lanes):
+    buf = bytearray(struct.pack(_LANE_COUNT, len(lanes)))
+    for lane in lanes:
+        buf.extend(struct.pack(_LANE_HEADER, lane.kind >> 4, lane.controller, len(lane.values)))
+        for delta in lane.deltas:
+            _put_varint(buf, delta)
+        for value in lane.values:
+            _put_varint(buf, _zigzag(value))
+    return buf
+
+
+def _decode_lanes(f):
+    """Read one track's lanes as a list of (kind, controller, deltas, values)."""
+    num_lanes, = struct.unpack(_LANE_COUNT, f.read(struct.calcsize(_LANE_COUNT)))
+    lanes = []
+    for _ in range(num_lanes):
+        kind, controller, num_points = struct.unpack(_LANE_HEADER, f.read(struct.calcsize(_LANE_HEADER)))
+        # Varints are at most 5 bytes each here; read what's needed and decode in place.
+        data = f.read(10 * num_points)
+        pos = 0
+        deltas = []
+        for _ in range(num_points):
+            delta, pos = _get_varint(data, pos)
+            deltas.append(delta)
+        values = []
+        for _ in range(num_points):
+            value, pos = _get_varint(data, pos)
+            values.append(_unzigzag(value))
+        f.seek(pos - len(data), 1)
+        lanes.append((kind << 4, controller, deltas, values))
+    return lanes
+
+
+def _encode_block(notes):
+    """Return (data, first_tick, last_tick) for a list of on_tick-sorted notes."""
+    buf = bytearray()
+    ons = [int(round(n.on_tick)) for n in notes]
+    first = prev = ons[0]
+    last = first
+    for on in ons:
+        _put_varint(buf, on - prev)
+        prev = on
+    for on, n in zip(ons, notes):
+        if n.off_tick is None:
+            _put_varint(buf, 0)
+        else:
+            off = max(on, int(round(n.off_tick)))
+            last = max(last, off)
+            _put_varint(buf, off - on + 1)
+    for n in notes:
+        _put_varint(buf, n.channel)
+    buf.extend(bytes(n.note & 0x7f for n in notes))
+    buf.extend(bytes(n.vel & 0x7f for n in notes))
+    return buf, first, max(last, prev)
+
+
+def _decode_block(data, first_tick, num_notes):
+    """Return the block's notes as (on_tick, duration, channel, note, vel) tuples."""
+    pos = 0
+    ons = []
+    on = first_tick
+    for _ in range(num_notes):
+        delta, pos = _get_varint(data, pos)
+        on += delta
+        ons.append(on)
+    durations = []
+    for _ in range(num_notes):
+        duration, pos = _get_varint(data, pos)
+        durations.append(duration - 1 if duration else None)
+    channels = []
+    for _ in range(num_notes):
+        channel, pos = _get_varint(data, pos)
+        channels.append(channel)
+    notes = data[pos : pos + num_notes]
+    vels = data[pos + num_notes : pos + 2 * num_notes]
+    return [(ons[i], durations[i], channels[i], notes[i], vels[i]) for i in range(num_notes)]
+
+
+def write_sequence(filename, tracks, tempo_segments, automation=None, block_size=256):
+    """Write tracks, each a list of on_tick-sorted notes, as a binary sequence.
+
+    Notes need on_tick, off_tick, channel, note and vel attributes.
+    tempo_segments is a list of (start_tick, bpm).  automation, if given,
+    has a list of lanes for each track; lanes need kind, controller, deltas
+    and values attributes.
+    """
+    for t, notes in enumerate(tracks):
+        for i in range(1, len(notes)):
+            if notes[i].on_tick < notes[i - 1].on_tick:
+                # Checked before the file is touched; the deltas can't be negative.
+                raise ValueError('track %d notes are out of order at index %d' % (t, i))
+    num_blocks = [(len(notes) + block_size - 1) // block_size for notes in tracks]
+    automation_offset_offset = SEQ_HEADER_SIZE + TEMPO_HEADER_SIZE + len(tempo_segments) * TEMPO_ENTRY_SIZE
+    track_table_offset = automation_offset_offset + AUTOMATION_OFFSET_SIZE
+    tables_offset = track_table_offset + len(tracks) * TRACK_ENTRY_SIZE
+    with open(filename, 'wb') as f:
+        f.write(struct.pack(_SEQ_HEADER, SEQ_MAGIC, SEQ_VERSION, len(tracks), block_size))
+        f.write(struct.pack(_TEMPO_HEADER, len(tempo_segments)))
+        for tick, bpm in tempo_segments:
+            f.write(struct.pack(_TEMPO_ENTRY, tick, bpm))
+        # Filled in once the blocks are written.
+        f.write(bytes(AUTOMATION_OFFSET_SIZE))
+        offset = tables_offset
+        for notes, blocks in zip(tracks, num_blocks):
+            f.write(struct.pack(_TRACK_ENTRY, len(notes), blocks, offset))
+            offset += blocks * BLOCK_ENTRY_SIZE
+        # Reserve the block tables; they're filled in once the blocks are written.
+        f.write(bytes(offset - tables_offset))
+        entries = []
+        for notes in tracks:
+            for start in range(0, len(notes), block_size):
+                block = notes[start : start + block_size]
+                data, first, last = _encode_block(block)
+                entries.append(struct.pack(_BLOCK_ENTRY, first, last, offset, len(data), len(block)))
+                f.write(data)
+                offset += len(data)
+        for t in range(len(tracks)):
+            f.write(_encode_lanes(automation[t] if automation else []))
+        f.seek(automation_offset_offset)
+        f.write(struct.pack(_AUTOMATION_OFFSET, offset))
+        f.seek(tables_offset)
+        for entry in entries:
+            f.write(entry)
+
+
+class SequenceReader:
+    """Random access to the blocks of a binary sequence, reading only the tables up front.
+
+    Raises ValueError if the file is corrupt or truncated, as it might be
+    after a crash mid-save.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        try:
+            self._read_tables(filename)
+        except (_STRUCT_ERROR, IndexError) as e:
+            self.file.close()
+            raise ValueError('%s is damaged: %s' % (filename, e))
+        except ValueError:
+            self.file.close()
+            raise
+
+    def _read_tables(self, filename):
+        magic, self.version, num_tracks, self.block_size = struct.unpack(
+            _SEQ_HEADER, self.file.read(SEQ_HEADER_SIZE))
+        if magic != SEQ_MAGIC or not 1 <= self.version <= SEQ_VERSION:
+            raise ValueError('%s is not a dpweseq sequence' % filename)
+        # List of (start_tick, bpm); empty for version 1.
+        self.tempo_segments = []
+        if self.version >= 2:
+            num_segments, = struct.unpack(_TEMPO_HEADER, self.file.read(TEMPO_HEADER_SIZE))
+            table = self.file.read(num_segments * TEMPO_ENTRY_SIZE)
+            self.tempo_segments = [struct.unpack_from(_TEMPO_ENTRY, table, i * TEMPO_ENTRY_SIZE)
+                                   for i in range(num_segments)]
+        automation_offset = 0
+        if self.version >= 3:
+            automation_offset, = struct.unpack(_AUTOMATION_OFFSET, self.file.read(AUTOMATION_OFFSET_SIZE))
+        track_table = self.file.read(num_tracks * TRACK_ENTRY_SIZE)
+        # For each track, a list of (first_tick, last_tick, offset, length, num_notes).
+        self.blocks = []
+        for track in range(num_tracks):
+            _, num_blocks, offset = struct.unpack_from(_TRACK_ENTRY, track_table, track * TRACK_ENTRY_SIZE)
+            self.file.seek(offset)
+            table = self.file.read(num_blocks * BLOCK_ENTRY_SIZE)
+            self.blocks.append([struct.unpack_from(_BLOCK_ENTRY, table, i * BLOCK_ENTRY_SIZE)
+                                for i in range(num_blocks)])
+        # For each track, a list of (kind, controller, tick deltas, values); empty before version 3.
+        self.automation = [[] for _ in range(num_tracks)]
+        if automation_offset:
+            self.file.seek(automation_offset)
+            self.automation = [_decode_lanes(self.file) for _ in range(num_tracks)]
+
+    def read_block(self, track, block):
+        first, _, offset, length, num_notes = self.blocks[track][block]
+        self.file.seek(offset)
+        try:
+            return _decode_block(self.file.read(length), first, num_notes)
+        except IndexError:
+            raise ValueError('block %d of track %d is damaged' % (block, track))
+
+    def close(self):
+        self.file.close()
+
+
+def replace_file(new_filename, filename):
+    """Move new_filename (filename + '.tmp') over filename.
+
+    MicroPython can't rename over an existing file, so filename is removed
+    first; a crash between the two leaves only new_filename, which
+    recover_file() puts back.
+    """
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+    os.rename(new_filename, filename)
+
+
+def recover_file(filename):
+    """If replace_file() was cut short, leaving only filename + '.tmp', finish it."""
+    try:
+        os.stat(filename)
+        return False
+    except OSError:
+        pass
+    try:
+        os.rename(filename + '.tmp', filename)
+    except OSError:
+        return False
+    return True